@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Check that the single-pass `docgen.analyse` finds the same indents and 
+skipped lines as the former `indents` / `skip_lines` / `scan` / `Locator`
+pipeline and compare the speed of their analysis of the tokens of a 
+multi-thousand-line source.
+"""
+
+# Docgen
+import common
+import docgen
+import reference
+
+def outcome(function, text):
+    # The result of `function(text)` or the type of the exception it raises.
+    try:
+        return function(text)
+    except Exception, error:
+        return type(error)
+
+def main():
+    failures = []
+    sources = common.sources(limit=150)
+    for filename, text in sources:
+        if outcome(docgen.skip_lines, text) != \
+           outcome(reference.skip_lines, text):
+            failures.append(filename + " (skip_lines)")
+        if outcome(docgen.indents, text) != outcome(reference.indents, text):
+            failures.append(filename + " (indents)")
+    common.check("analyse ({0} files)".format(len(sources)), failures)
+
+    # The regular expression tokenizer fails on many modules (the analysis 
+    # is the fallback of `make_tree` for non-Python sources): the large 
+    # source is made of the modules that it handles.
+    texts = [text for _, text in common.sources() 
+             if isinstance(outcome(docgen.indents, text), list)]
+    text, lines = "", 0
+    while lines < 5000 and texts:
+        text += texts.pop(0) + "\n"
+        lines = text.count("\n")
+    assert isinstance(outcome(docgen.indents, text), list)
+
+    # Both pipelines start with the same tokenizer: the tokens are computed 
+    # once, so that only the analysis of the tokens is measured.
+    tokens = docgen.tokenize(text)
+    print "tokenize, {0} lines: {1:.3f}s".format(
+      lines, common.timeit(docgen.tokenize, text))
+    tokenize, docgen.tokenize = docgen.tokenize, lambda text: list(tokens)
+    try:
+        for name in ["skip_lines", "indents"]:
+            old = common.timeit(outcome, getattr(reference, name), text)
+            new = common.timeit(outcome, getattr(docgen, name), text)
+            template = "{0} (without tokenize), {1} lines: {2:.3f}s -> {3:.3f}s"
+            print template.format(name, lines, old, new)
+    finally:
+        docgen.tokenize = tokenize
+
+if __name__ == "__main__":
+    main()
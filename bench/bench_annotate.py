@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Check that `docgen.annotate` produces the same trees as the former 
+`commentify` and `decoratify` passes and compare their speed on a node 
+with thousands of comment blocks.
+"""
+
+# Docgen
+import common
+import docgen
+import reference
+
+def signature(tree):
+    # The nested description of a tree, with the class and text of the 
+    # markdown comments and decorators.
+    info, children = tree
+    object = getattr(info, "object", None)
+    if isinstance(object, (docgen.Markdown, docgen.Decorator)):
+        object = (type(object).__name__, str(object))
+    else:
+        object = None
+    return (info.name, info.lineno, info.type, getattr(info, "source", None),
+            object, [signature(child) for child in children])
+
+def former(tree):
+    reference.commentify(tree)
+    reference.decoratify(tree)
+
+def main():
+    failures, count = [], 0
+    for filename, text in common.sources(limit=300):
+        try:
+            old, new = docgen.make_tree(text), docgen.make_tree(text)
+        except Exception:
+            continue
+        count += 1
+        former(old)
+        docgen.annotate(new)
+        if signature(old) != signature(new):
+            failures.append(filename)
+    common.check("annotate ({0} files)".format(count), failures)
+
+    # A single node whose source holds all the comments: the former passes
+    # count the lines of the source before every comment.
+    lines = ["x = 1"]
+    for i in range(20000):
+        lines += ["", "#", "# Comment {0}".format(i), "#"]
+    lines += ["y = 2"]
+    text = "\n".join(lines)
+    old = common.timeit(lambda: former(docgen.make_tree(text)), repeat=1)
+    new = common.timeit(lambda: docgen.annotate(docgen.make_tree(text)))
+    build = common.timeit(docgen.make_tree, text)
+    template = "annotate, 20000 comments: {0:.3f}s -> {1:.3f}s"
+    print template.format(old - build, new - build)
+
+if __name__ == "__main__":
+    main()
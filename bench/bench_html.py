@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Check the output of `docgen.iter_html` on sample documents -- non-ASCII 
+text, reference links, object headers, escapes, footnotes -- check that 
+it is streamed and measure its speed on a large documentation.
+"""
+
+# Python 2.7 Standard Library
+import os
+import shutil
+import tempfile
+
+# Docgen
+import common
+import docgen
+
+SAMPLES = [
+    (["S\xc3\xa9bastien, see [docs](http://x.org).\n"],
+     u'<p>S\xe9bastien, see <a href="http://x.org">docs</a>.</p>\n'),
+    ([u"R\xe9f\xe9rences\n", "-----------\n"], 
+     u"<h2>R\xe9f\xe9rences</h2>\n"),
+    (["### `f` [`function`]\n"], 
+     u"<h3><code>f</code> [<code>function</code>]</h3>\n"),
+    (["See [the docs][docs], [docs] and [a].\n\n[docs]: http://d\n"],
+     u'<p>See <a href="http://d">the docs</a>, [docs] and [a].</p>\n'),
+    (["[docs]: http://d\n\nSee [docs].\n"],
+     u'<p>See <a href="http://d">docs</a>.</p>\n'),
+    (["Use \\*args\\* and \\[x].\n"],
+     u"<p>Use &#42;args&#42; and &#91;x].</p>\n"),
+    (["Text[^1].\n\n[^1]: note\n"],
+     u"<p>Text[^1].</p>\n<p>[^1]: note</p>\n"),
+    (["- a\n- *b* & <span>c</span>\n\nText:\n\n    code <x>\n"],
+     u"<ul>\n<li>a</li>\n<li><em>b</em> &amp; <span>c</span></li>\n</ul>\n"
+     u"<p>Text:</p>\n<pre><code>code &lt;x&gt;\n</code></pre>\n"),
+]
+
+def body(chunks):
+    html = list(docgen.iter_html(chunks))
+    return u"".join(html[1:-1])
+
+def streamed():
+    # Return the HTML chunks produced before the end of the markdown chunks.
+    html = []
+    def chunks():
+        yield "Title\n=====\n\n### `f` [`function`]\n\nText.\n\n"
+        yield "### `C` [`type`]\n\n"
+        html.extend(output)
+    output = []
+    for chunk in docgen.iter_html(chunks()):
+        output.append(chunk)
+    return html
+
+def main():
+    failures = []
+    for chunks, expected in SAMPLES:
+        if body(chunks) != expected:
+            failures.append(repr(body(chunks)))
+    if len(streamed()) < 5: # template, h1, h3, p, h3
+        failures.append("not streamed")
+    directory = tempfile.mkdtemp()
+    try:
+        output = os.path.join(directory, "sample.html")
+        docgen.write_html(SAMPLES[1][0], output)
+        if SAMPLES[1][1].encode("utf-8") not in open(output).read():
+            failures.append("write_html")
+    finally:
+        shutil.rmtree(directory)
+    common.check("iter_html ({0} samples)".format(len(SAMPLES)), failures)
+
+    markdown = "".join(docgen.iter_document("docgen"))
+    lines = markdown.count("\n")
+    html = lambda: u"".join(docgen.iter_html([markdown]))
+    print "iter_html, {0} lines: {1:.3f}s".format(lines, common.timeit(html))
+
+if __name__ == "__main__":
+    main()
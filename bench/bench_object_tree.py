@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Check that `docgen.object_tree` builds the same trees as the former 
+implementation and compare their speed on large modules (stdlib modules, numpy when it is 
+installed and a synthetic module with 1000 classes).
+"""
+
+# Python 2.7 Standard Library
+import importlib
+import sys
+import types
+
+# Docgen
+import common
+import docgen
+import reference
+
+MODULES = ["Tkinter", "argparse", "collections", "cookielib", "decimal", 
+           "difflib", "email.message", "ftplib", "httplib", "inspect", 
+           "logging", "mailbox", "optparse", "pydoc", "smtplib", "tarfile",
+           "urllib2", "xml.dom.minidom", "zipfile", "numpy"]
+
+def synthetic_module(classes=1000):
+    "Return a module with `classes` classes of 5 methods"
+    module = types.ModuleType("synthetic")
+    lines = []
+    for i in range(classes):
+        lines.append("class C{0}(object):".format(i))
+        for j in range(5):
+            lines.append("    def m{0}(self): pass".format(j))
+    exec "\n".join(lines) in vars(module)
+    return module
+
+def compare(old, new, aliases, failures):
+    # Compare the names and items of two trees and check that their shared 
+    # children lists are shared in the same way.
+    stack = [(old, new)]
+    while stack:
+        (name, item, children), (_name, _item, _children) = stack.pop()
+        if name != _name or item is not _item or \
+           len(children) != len(_children):
+            failures.append(name)
+            continue
+        key = id(children)
+        if key in aliases:
+            if aliases[key] != id(_children):
+                failures.append(name)
+            continue
+        aliases[key] = id(_children)
+        stack.extend(zip(children, _children))
+
+def main():
+    modules = []
+    for name in MODULES:
+        try:
+            modules.append(importlib.import_module(name))
+        except ImportError:
+            pass
+    synthetic = synthetic_module()
+    sys.modules[synthetic.__name__] = synthetic
+    modules.append(synthetic)
+    failures = []
+    for module in modules:
+        compare(reference.object_tree(module), docgen.object_tree(module), 
+                {}, failures)
+    common.check("object_tree ({0} modules)".format(len(modules)), failures)
+
+    def walk(object_tree):
+        for module in modules:
+            object_tree(module)
+    old = common.timeit(walk, reference.object_tree, repeat=1)
+    new = common.timeit(walk, docgen.object_tree)
+    print "object_tree: {0:.3f}s -> {1:.3f}s".format(old, new)
+
+if __name__ == "__main__":
+    main()
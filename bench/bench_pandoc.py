@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Check that the compact Pandoc types encode the same documents as the former
+ones and compare the construction time and memory use of both on a large 
+decoded document.
+"""
+
+# Python 2.7 Standard Library
+import json
+import sys
+
+# Docgen
+import common
+import docgen
+import reference
+
+META = {"docTitle": [], "docAuthors": [], "docDate": []}
+
+def words(text):
+    "Return the inlines of `text`"
+    inlines = []
+    for word in text.split():
+        if inlines:
+            inlines.append("Space")
+        inlines.append({"Str": word})
+    return inlines
+
+def large_document(blocks=4000):
+    "Return the (pandoc 1.9) JSON text of a document with `blocks` blocks"
+    items = []
+    for i in range(blocks):
+        if i % 10 == 0:
+            items.append({"Header": [2, words(u"Section {0}".format(i))]})
+        else:
+            inlines = words(u"The function returns the value of the item.")
+            inlines += ["Space", {"Emph": words(u"not")}, "Space"]
+            inlines += [{"Code": [["", [], []], u"f({0})".format(i)]}]
+            inlines += ["Space", {"Link": [words(u"see also"), 
+                                           [u"#item-{0}".format(i), u""]]}]
+            inlines += ["Space"] + words(u"R\u00e9f\u00e9rences \u00e0 la fin.")
+            items.append({"Para": inlines})
+    return json.dumps([META, items])
+
+def size(tree):
+    "Return the size in bytes of the instances, arguments and strings of `tree`"
+    total, seen, stack = 0, set(), [tree]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, (docgen.PandocType, reference.PandocType)):
+            if hasattr(item, "__dict__"):
+                total += sys.getsizeof(item.__dict__)
+            stack.append(item.args)
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+    return total
+
+def main():
+    json_text = large_document()
+    old = reference.to_pandoc(json.loads(json_text))
+    failures = []
+    for new in [docgen.to_pandoc(json.loads(json_text)), 
+                docgen.read_json(json_text)]:
+        if json.dumps(docgen.to_json(new)) != json.dumps(docgen.to_json(old)):
+            failures.append(type(new).__name__)
+    common.check("pandoc types", failures)
+
+    def build(to_pandoc):
+        to_pandoc(json.loads(json_text))
+    old_time = common.timeit(build, reference.to_pandoc)
+    new_time = common.timeit(build, docgen.to_pandoc)
+    hook_time = common.timeit(docgen.read_json, json_text)
+    print "to_pandoc, 4000 blocks: {0:.3f}s -> {1:.3f}s (read_json: {2:.3f}s)"\
+          .format(old_time, new_time, hook_time)
+    old_size = size(old) / 2.0 ** 20
+    new_size = size(docgen.read_json(json_text)) / 2.0 ** 20
+    print "pandoc tree, 4000 blocks: {0:.1f} MiB -> {1:.1f} MiB"\
+          .format(old_size, new_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Measure the startup of docgen -- `import docgen` and `docgen --help` -- in
+fresh interpreters and check that the heavy modules are imported lazily.
+
+The timings are the best of several runs, minus the startup of a bare
+interpreter. The check fails when `import docgen` imports a module of
+`HEAVY` or when a timing exceeds its budget; the budgets (in seconds) may
+be given on the command-line:
+
+    python bench/bench_startup.py [IMPORT_BUDGET [HELP_BUDGET]]
+"""
+
+# Python 2.7 Standard Library
+import os
+import subprocess
+import sys
+import time
+
+# Docgen
+import common
+
+HEAVY = ["cgi", "copy", "doctest", "multiprocessing", "pydoc", "sh", "script",
+         "shutil", "subprocess", "tempfile"]
+
+BUDGETS = [0.15, 0.3]
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+def python(*args):
+    env = os.environ.copy()
+    paths = [root] + filter(None, [env.get("PYTHONPATH")])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    process = subprocess.Popen([sys.executable] + list(args), env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate()
+    if process.returncode:
+        raise RuntimeError(error)
+    return output
+
+def startup(*args, **options):
+    "Return the best wall time of `python(*args)`, in seconds."
+    repeat = options.get("repeat", 10)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        python(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    budgets = [float(arg) for arg in sys.argv[1:]] + BUDGETS[len(sys.argv)-1:]
+
+    output = python("-c", "import sys, docgen; print ' '.join(sys.modules)")
+    modules = output.split()
+    failures = [name for name in HEAVY if name in modules]
+    common.check("lazy imports ({0} modules)".format(len(HEAVY)), failures)
+
+    bare = startup("-c", "pass")
+    timings = [("import docgen", startup("-c", "import docgen")),
+               ("docgen --help", startup("-m", "docgen", "--help"))]
+    failures = []
+    for (name, timing), budget in zip(timings, budgets):
+        timing -= bare
+        print "{0}: {1:.3f}s (budget: {2:.3f}s)".format(name, timing, budget)
+        if timing > budget:
+            failures.append("{0}: {1:.3f}s > {2:.3f}s".format(name, timing, budget))
+    common.check("startup", failures)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""
+Check that `docgen.tokenize` produces the same tokens as the former 
+tokenizer and compare their speed on a multi-thousand-line source.
+"""
+
+# Python 2.7 Standard Library
+import sys
+
+# Docgen
+import common
+import docgen
+import reference
+
+def main():
+    failures, count = [], 0
+    for filename, text in common.sources(limit=150):
+        expected = reference.tokenize(text)
+        count += len(expected)
+        if docgen.tokenize(text) != expected:
+            failures.append(filename)
+    common.check("tokenize ({0} tokens)".format(count), failures)
+
+    text = common.large_source(5000)
+    lines = text.count("\n")
+    old = common.timeit(reference.tokenize, text, repeat=1)
+    new = common.timeit(docgen.tokenize, text)
+    print "tokenize, {0} lines: {1:.3f}s -> {2:.3f}s".format(lines, old, new)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Shared helpers of the docgen benchmarks and equivalence checks.
+"""
+
+# Python 2.7 Standard Library
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+def sources(limit=None):
+    """
+    Return the `(filename, text)` pairs of the standard library modules.
+    """
+    root = os.path.dirname(os.__file__)
+    items = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames 
+                             if name not in ("site-packages", "test"))
+        for filename in sorted(filenames):
+            if filename.endswith(".py"):
+                path = os.path.join(dirpath, filename)
+                items.append((path, open(path).read()))
+                if limit is not None and len(items) >= limit:
+                    return items
+    return items
+
+def large_source(lines=5000):
+    """
+    Return a source text of at least `lines` lines, made of stdlib modules.
+    """
+    parts, count = [], 0
+    for _, text in sources():
+        parts.append(text)
+        count += text.count("\n")
+        if count >= lines:
+            break
+    return "\n".join(parts)
+
+def timeit(function, *args, **options):
+    """
+    Return the best time (in seconds) of `repeat` calls of `function(*args)`.
+    """
+    repeat = options.get("repeat", 3)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def check(name, failures):
+    """
+    Report the failures of the check `name` and exit with an error if any.
+    """
+    for failure in failures[:10]:
+        print "  mismatch:", failure
+    if failures:
+        print "{0}: FAILED ({1} mismatches)".format(name, len(failures))
+        sys.exit(1)
+    print "{0}: ok".format(name)
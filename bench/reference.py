@@ -0,0 +1,286 @@
+"""
+Reference implementations for the equivalence checks.
+
+These are the former versions of docgen functions that were rewritten
+for speed; the checks compare them with the current implementations.
+"""
+
+# Python 2.7 Standard Library
+import array
+import bisect
+import inspect
+import re
+import types
+
+# Docgen
+import common # docgen path
+import docgen
+from docgen import finder, sort_items
+from docgen import _hidden_magic, is_external, star_import_index, tab_match
+from docgen import Decorator, Info, Markdown, _comment_pattern, _decorator_pattern
+
+def tokenize(text):
+    "Former `docgen.tokenize`: every pattern is searched after each token."
+    finders  = []
+    finders += [finder(symbol) for symbol in "( [ { ) ] }".split()]
+    finders += [finder("BLANKLINE", r"(^[ \t\r\f\v]*\n)", re.MULTILINE)]
+    finders += [finder("COMMENT"  , r"([ \t\r\f\v]*#.*\n?(?:[ \t\r\f\v]*#.*\n?)*)")]
+    finders += [finder("LINECONT" , r"(\\\n)")]
+    finders += [finder("STRING"   , r'("(?:[^"]|\\")*")')]
+    finders += [finder("STRING"   , r'("""(?:[^"]|\\"|"{1,2}(?!"))*""")')]
+    finders += [finder("STRING"   , r"('(?: [^']|\\')*')")]
+    finders += [finder("STRING"   , r"('''(?:[^']|\\'|'{1,2}(?!'))*''')")]
+
+    start = 0
+    items = []
+    while start < len(text):
+        results = []
+        for find in finders:
+            result = find(text, start)
+            if result is not None:
+                results.append(result)
+        if results:
+            sort_items(results)
+            result = results[0]
+            items.append(result)
+            start = result[2]
+        else:
+            break
+    return items
+
+class Locator(object):
+    """
+    Former `docgen.Locator`: convert offsets in `text` into locations 
+    `(lineno, rel_offset)`.
+    """
+    def __init__(self, text):
+        self._offsets = array.array("l", [0])
+        for line in text.split("\n"):
+            self._offsets.append(self._offsets[-1] + len(line) + 1)
+
+    def __call__(self, offset):
+        i = bisect.bisect_right(self._offsets, offset)
+        if i < len(self._offsets):
+            return (i - 1, offset - self._offsets[i-1])
+
+    def locations(self, offsets):
+        _offsets = self._offsets
+        n = len(_offsets)
+        locations = [None] * len(offsets)
+        order = sorted(range(len(offsets)), key=offsets.__getitem__)
+        i = 1
+        for k in order:
+            offset = offsets[k]
+            while i < n and _offsets[i] <= offset:
+                i += 1
+            if i < n:
+                locations[k] = (i - 1, offset - _offsets[i-1])
+        return locations
+
+    def offset(self, lineno, rel_offset):
+         return self._offsets[lineno] + rel_offset
+
+def scan(text):
+    """
+    Former `docgen.scan`.
+
+    Its bracket test was on a (leaked) global `name` instead of `symbol`,
+    so it never paired the brackets; this behaviour is kept here.
+    """
+    match = {"(": ")", "[": "]", "{": "}", ")": "(", "]": "[", "}": "{"}
+    wait_for = []
+    items = []
+
+    for symbol, start, end in docgen.tokenize(text):
+        if False: # was: name in ["(", "[", "{"]
+            wait_for.append((match[symbol], start))
+        elif wait_for and symbol == wait_for[-1][0]:
+            _, start = wait_for.pop()
+            items.append((match[symbol] + symbol, start, end))
+        else:
+            items.append((symbol, start, end))
+
+    sort_items(items)
+    return items
+
+def skip_lines(text):
+    "Former `docgen.skip_lines`, based on `scan` and `Locator`."
+    lines = []
+    items = scan(text)
+    offsets = [item[1] for item in items] + [item[2] for item in items]
+    locations = Locator(text).locations(offsets)
+    for i, (name, _, _) in enumerate(items):
+        start, end = locations[i], locations[len(items) + i]
+        if name == "BLANKLINE":
+            lines.append(start[0])
+        if name == "COMMENT":
+            start_line = start[0] + (start[1] != 0)
+            end_line = end[0] - 1
+            lines += [line for line in range(start_line, end_line + 1)]
+        if name == "LINECONT":
+            lines.append(start[0] + 1)
+        if name in "() [] {} STRING".split():
+            start_line = start[0] + 1
+            end_line = end[0]
+            lines += [line for line in range(start_line, end_line + 1)]
+    return set(lines)
+
+def indents(text):
+    "Former `docgen.indents`, based on `skip_lines`."
+    skip = skip_lines(text)
+    tabs = []
+    indents = []
+    for i, line in enumerate(text.split("\n")):
+        if i not in skip:
+            match, extra = tab_match(line, tabs)
+            if extra:
+                indents.append((i, +1))
+                tabs.append(extra)
+            else:
+                indents.append((i, len(match) - len(tabs)))
+                tabs = tabs[:len(match)]
+    return indents
+
+def object_tree(item, name=None, module=None, _cache=None, _star_imports=None):
+    "Former `docgen.object_tree`: the visited items are found by list scans."
+    if name is None:
+        if hasattr(item, "__module__"):
+            name = item.__module__ + "." + item.__name__
+        else:
+            name = item.__name__
+    if module is None and isinstance(item, types.ModuleType):
+        module = item
+
+    tree = (name, item, [])
+    if _cache is None:
+        _cache = ([], [])
+    if id(item) not in [id(x) for x in _cache[0]]:
+        _cache[0].append(item)
+        _cache[1].append(tree[2])
+    if isinstance(item, types.ModuleType):
+        children = inspect.getmembers(item)
+    elif isinstance(item, type):
+        children = item.__dict__.items() 
+    else:
+        children = []
+
+    MethodWrapper = type((lambda: None).__call__)
+
+    def is_local(item, name):
+        if module:
+            return getattr(_item, "__module__", module.__name__) == module.__name__
+        else:
+            return True
+
+    if _star_imports is None:
+        _star_imports = star_import_index(module)
+
+    for _name, _item in children:
+        if (not _name.startswith("_") or (_name.startswith("__") and _name.endswith("__") and not _name in _hidden_magic)) and \
+           not isinstance(_item, types.ModuleType) and \
+           is_local(item, name) and \
+           not is_external(_item, _name, _star_imports) and \
+           not isinstance(_item, MethodWrapper):
+           _name = name + "." + _name
+           if id(_item) in [id(x) for x in _cache[0]]:
+               index = [id(x) for x in _cache[0]].index(id(_item))
+               new = (_name, _item, _cache[1][index])
+           else:
+               new = object_tree(_item, _name, module, _cache, _star_imports)
+           tree[2].append(new)
+    return tree
+
+def commentify(tree):
+    "Former `docgen.commentify`: extract the markdown comments of a tree."
+    source = getattr(tree[0], "source", None)
+    object = getattr(tree[0], "object", None)
+    if source is not None and (object is None or not isinstance(object, Markdown)):
+        matches = list(_comment_pattern.finditer(source))
+        for i, match in enumerate(matches):
+            start = match.start()
+            end = match.end()
+            if i == 0:
+                tree[0].source = source[:start]
+            if i+1 < len(matches):
+                next = matches[i+1].start()
+            else:
+                next = len(source)
+            comment = Markdown.from_comment(source[start:end])
+            line_start = source.count("\n", 0, start)
+            info = Info(name=None, lineno=tree[0].lineno + line_start, 
+                        object=comment, type=None)
+            info.source = source[start:next]
+            tree[1].insert(i, (info, []))
+
+    for child in tree[1]:
+        commentify(child)
+
+def decoratify(tree):
+    "Former `docgen.decoratify`: extract the decorators of a tree."
+    source = getattr(tree[0], "source", None)
+    object = getattr(tree[0], "object", None)
+    if source is not None and (object is None or not isinstance(object, Decorator)):
+        matches = list(_decorator_pattern.finditer(source))
+        for i, match in enumerate(matches):
+            start = match.start()
+            end = match.end()
+            if i == 0:
+                tree[0].source = source[:start]
+            if i+1 < len(matches):
+                next = matches[i+1].start()
+            else:
+                next = len(source)
+            decorator = Decorator(source[start:end].strip())
+            line_start = source.count("\n", 0, start)
+            info = Info(name=None, lineno=tree[0].lineno + line_start, 
+                        object=decorator, type=None)
+            info.source = source[start:next]
+            tree[1].insert(i, (info, []))
+
+    for child in tree[1]:
+        decoratify(child)
+
+class PandocType(object):
+    """
+    Former `docgen.PandocType`: the arguments are stored in a list, in the 
+    instance dictionary.
+    """
+    def __init__(self, *args):
+        self.args = list(args)
+    def __iter__(self):
+        return iter(self.args)
+    def __json__(self):
+        return {type(self).__name__: docgen.to_json(list(self.args))}
+
+class Pandoc(PandocType):
+    "Former `docgen.Pandoc`"
+    def __json__(self):
+        meta, blocks = self.args[0], self.args[1]
+        return [meta, [docgen.to_json(block) for block in blocks]]
+
+class Str(PandocType):
+    "Former `docgen.Str`"
+    def __init__(self, *args):
+        self.args = [u"".join(args)]
+    def __json__(self):
+        return {"Str": self.args[0]}
+
+_pandoc_types = {"Pandoc": Pandoc, "Str": Str}
+
+def pandoc_type(name):
+    "Return the former Pandoc type named `name`"
+    if name not in _pandoc_types:
+        _pandoc_types[name] = type(str(name), (PandocType,), {})
+    return _pandoc_types[name]
+
+def to_pandoc(json):
+    "Former `docgen.to_pandoc`: build the former Pandoc types, recursively."
+    if docgen.is_doc(json):
+        return Pandoc(*[to_pandoc(item) for item in json])
+    elif isinstance(json, list):
+        return [to_pandoc(item) for item in json]
+    elif isinstance(json, dict) and len(json) == 1:
+        key, args = json.items()[0]
+        return pandoc_type(key)(*to_pandoc(args))
+    else:
+        return json
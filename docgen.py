@@ -18,21 +18,24 @@ document converter.
 """
 
 # Python 2.7 Standard Library
-import copy
+import ast
+import contextlib
+import hashlib
 import importlib
 import inspect
 import json
+import marshal
 import os
-import pydoc
+import pkgutil
 import re
-import shutil
 import sys
-import tempfile
+import time
 import types
 
-# Third-Party Libraries
-import script
-import sh
+# Rk: the modules that only some commands need -- the third-party libraries
+#     `script` and `sh`, `copy`, `multiprocessing`, `shutil`, `subprocess`
+#     and `tempfile` -- are imported in the functions that use them, so that
+#     `import docgen` and `docgen --help` stay fast.
 
 #
 # Metadata 
@@ -90,30 +93,52 @@ __version__ = "0.0.0a1"
 
 def _tree_iter(item):
     "Tree iterator"
-    yield item
-    if not isinstance(item, basestring):
-        try:
-            it = iter(item)
-            for subitem in it:
-                for subsubitem in _tree_iter(subitem):
-                    yield subsubitem
-        except TypeError:
-            pass
+    stack = [item]
+    while stack:
+        item = stack.pop()
+        yield item
+        if not isinstance(item, basestring):
+            try:
+                children = list(item)
+            except TypeError:
+                continue
+            children.reverse()
+            stack.extend(children)
+
+def _nodes(item):
+    "Pandoc instances iterator"
+    stack = [item]
+    pop, extend = stack.pop, stack.extend
+    while stack:
+        item = pop()
+        if isinstance(item, PandocType):
+            yield item
+            if type(item) is not Str:
+                extend(item.args[::-1])
+        elif isinstance(item, (list, tuple)):
+            extend(item[::-1])
 
 class PandocType(object):
     """
     Pandoc types base class
 
     Refer to the [Pandoc data structure definition](http://hackage.haskell.org/packages/archive/pandoc-types/1.8/doc/html/Text-Pandoc-Definition.html) (in Haskell) for details.
+
+    The instances are compact: they have no `__dict__` and their arguments 
+    `args` are stored in a tuple.
     """
+    __slots__ = ["args"]
     def __init__(self, *args):
-        self.args = list(args)
+        self.args = args
     def __iter__(self):
         "Child iterator"
         return iter(self.args)
     def iter(self):
         "Tree iterator"
         return _tree_iter(self)
+    def find(self, *types):
+        "Return the nodes of the tree that are instances of `types`"
+        return [node for node in _nodes(self) if isinstance(node, types)]
     def apply(self, transform): 
         apply(transform)(self)
     def __json__(self):
@@ -128,9 +153,35 @@ class PandocType(object):
         return "{0}({1})".format(typename, args)
 
 class Pandoc(PandocType):
+    """
+    Pandoc documents
+
+    The `find` method uses an index of the nodes by type, that is built on
+    the first call and reset by `apply`.
+    """
+    __slots__ = ["_index"]
+    def find(self, *types):
+        "Return the nodes of the document that are instances of `types`"
+        index = getattr(self, "_index", None)
+        if index is None:
+            index = self._index = {}
+            for node in _nodes(self):
+                try:
+                    index[type(node)].append(node)
+                except KeyError:
+                    index[type(node)] = [node]
+        matches = [nodes for type_, nodes in index.items() 
+                   if issubclass(type_, types)]
+        if len(matches) <= 1:
+            return list(matches[0]) if matches else []
+        else: # several types, the document order is needed.
+            return PandocType.find(self, *types)
+    def apply(self, transform):
+        PandocType.apply(self, transform)
+        self._index = None
     def __json__(self):
         meta, blocks = self.args[0], self.args[1]
-        return [meta, [to_json(block) for block in blocks]]
+        return [to_json(meta), [to_json(block) for block in blocks]]
     @staticmethod 
     def read(text):
         return read(text)
@@ -138,53 +189,74 @@ class Pandoc(PandocType):
         return write(self)
 
 class Block(PandocType):
-    pass
+    __slots__ = []
 
 class Header(Block):
-    pass
+    __slots__ = []
 
 class Table(Block):
-    pass
+    __slots__ = []
 
 class DefinitionList(Block):
-    pass
+    __slots__ = []
 
 class BulletList(Block):
-    pass
+    __slots__ = []
 
 class OrderedList(Block):
-    pass
+    __slots__ = []
 
 class Plain(Block):
-    pass
+    __slots__ = []
 
 class CodeBlock(Block):
-    pass
+    __slots__ = []
 
 class BlockQuote(Block):
-    pass
+    __slots__ = []
 
 class RawBlock(Block):
-    pass
+    __slots__ = []
 
 class Inline(PandocType):
-    pass
+    __slots__ = []
 
 class Emph(Inline):
-    pass
+    __slots__ = []
 
 class Para(Inline):
-    pass
+    __slots__ = []
 
 class Code(Inline):
-    pass
+    __slots__ = []
 
 class Link(Inline):
-    pass
+    __slots__ = []
 
 class Str(Inline):
+    """
+    Pandoc strings
+
+    Short strings are usually repeated many times in a document: use 
+    `Str.make` to get a shared instance. The shared instances should not 
+    be modified.
+    """
+    __slots__ = []
+    _shared = {}
     def __init__(self, *args):
-        self.args = [u"".join(args)]
+        self.args = (u"".join(args),)
+    @classmethod
+    def make(cls, text):
+        "Return a shared `Str` instance for short texts"
+        if len(text) > 16:
+            return cls(text)
+        try:
+            return cls._shared[text]
+        except KeyError:
+            if len(cls._shared) >= 65536:
+                cls._shared.clear()
+            instance = cls._shared[text] = cls(text)
+            return instance
     def __repr__(self):
         text = self.args[0]
         return "{0}({1!r})".format("Str", text)
@@ -199,11 +271,17 @@ class Str(Inline):
 # atom (inline) may appear but here we typically are not aware of that.
 #
 
+# The atoms are interned by `to_pandoc`: all the `Space` of a document are 
+# the same string object.
+
+_atoms = dict((name, name) for name in 
+              "Space LineBreak EmDash EnDash Apostrophe Ellipsis".split())
+
 class Strong(Inline):
-    pass
+    __slots__ = []
 
 class Math(Inline):
-    pass
+    __slots__ = []
 
 
 # TODO: check Pandoc version: in 1.12(.1 ?), change in the json output 
@@ -220,50 +298,696 @@ class Math(Inline):
 #       git version ... 1.12.3 ouch. What's in Ubuntu 13.04 ? 13.10 ? The 1.11.1
 #       Errr ... Try to build from git the git version and see if there is
 #       really a change in the JSON format ?
+_pandoc_types = {}
+
+def pandoc_type(name):
+    """
+    Return the Pandoc type named `name`.
+
+    The types are found in a registry of the `PandocType` subclasses;
+    the types that are unknown are created (as `PandocType` subclasses).
+    """
+    try:
+        return _pandoc_types[name]
+    except KeyError:
+        types_ = [PandocType]
+        while types_:
+            type_ = types_.pop()
+            _pandoc_types.setdefault(type_.__name__, type_)
+            types_.extend(type_.__subclasses__())
+        if name not in _pandoc_types:
+            new_type = type(str(name), (PandocType,), {"__slots__": []})
+            _pandoc_types[name] = new_type
+        return _pandoc_types[name]
+
+def is_doc(item):
+    "Test if `item` is a JSON (pandoc 1.9) document"
+    return isinstance(item, list) and \
+           len(item) == 2 and \
+           isinstance(item[0], dict) and \
+           "docTitle" in item[0].keys()
+
+_build = object() # stack marker
+
 def to_pandoc(json):
-    def is_doc(item):
-        return isinstance(item, list) and \
-               len(item) == 2 and \
-               isinstance(item[0], dict) and \
-               "docTitle" in item[0].keys()
-    if is_doc(json):
-        return Pandoc(*[to_pandoc(item) for item in json])
-    elif isinstance(json, list):
-        return [to_pandoc(item) for item in json]
-    elif isinstance(json, dict) and len(json) == 1:
-        key, args = json.items()[0]
-        pandoc_type = eval(key)
-        return pandoc_type(*to_pandoc(args))
+    """
+    Convert a JSON value (decoded by `json.loads`) into Pandoc instances.
+
+    The conversion is iterative, so that deeply nested documents do not 
+    reach the recursion limit.
+    """
+    root = [None]
+    stack = [(json, root, 0)] # (item, container, index) or build entries.
+    while stack:
+        entry = stack.pop()
+        if entry[0] is _build:
+            _, pandoc_type_, holder, container, index = entry
+            if pandoc_type_ is Str:
+                container[index] = Str.make(holder[0])
+            else:
+                container[index] = pandoc_type_(*holder[0])
+            continue
+        item, container, index = entry
+        if isinstance(item, list):
+            items = container[index] = [None] * len(item)
+            for i, subitem in enumerate(item):
+                stack.append((subitem, items, i))
+        elif isinstance(item, dict) and len(item) == 1:
+            key, args = item.items()[0]
+            holder = [None]
+            stack.append((_build, pandoc_type(key), holder, container, index))
+            stack.append((args, holder, 0))
+        elif isinstance(item, basestring):
+            container[index] = _atoms.get(item, item)
+        else:
+            container[index] = item
+    if is_doc(root[0]):
+        return Pandoc(*root[0])
+    else:
+        return root[0]
+
+def _intern_atoms(item):
+    if isinstance(item, list):
+        return [_intern_atoms(subitem) for subitem in item]
+    elif isinstance(item, basestring):
+        return _atoms.get(item, item)
+    else:
+        return item
+
+def _object_hook(dict_):
+    if len(dict_) != 1:
+        return dict_
+    key, args = dict_.items()[0]
+    pandoc_type_ = pandoc_type(key)
+    if pandoc_type_ is Str:
+        return Str.make(args)
+    return pandoc_type_(*_intern_atoms(args))
+
+def read_json(json_text):
+    """
+    Read a JSON text (produced by pandoc) as a Pandoc instance.
+
+    The Pandoc instances are created during the JSON parsing. This is 
+    recursive: when the document is too deep for the recursion limit, it is
+    parsed again with a higher limit -- still bounded, the JSON decoder uses
+    the C stack -- and converted by `to_pandoc`.
+    """
+    try:
+        doc = json.loads(json_text, object_hook=_object_hook)
+    except RuntimeError: # maximum recursion depth exceeded
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 20000))
+        try:
+            return to_pandoc(json.loads(json_text))
+        finally:
+            sys.setrecursionlimit(limit)
+    if is_doc(doc):
+        return Pandoc(*doc)
     else:
-        return json
-    
+        return doc
+
 def to_json(doc_item):
     if hasattr(doc_item, "__json__"):
         return doc_item.__json__()
     elif isinstance(doc_item, list):
         return [to_json(item) for item in doc_item]
+    elif isinstance(doc_item, dict):
+        return dict((key, to_json(value)) for key, value in doc_item.items())
     else:
         return doc_item
 
+#
+# Caches
+# ------------------------------------------------------------------------------
+#
+
+def cache_dir():
+    """
+    Return the docgen cache directory.
+
+    The directory is `$DOCGEN_CACHE` if this environment variable is defined,
+    and `~/.cache/docgen` otherwise. The caches are disabled when 
+    `$DOCGEN_CACHE` is empty.
+    """
+    path = os.environ.get("DOCGEN_CACHE")
+    if path is None:
+        path = os.path.join(os.path.expanduser("~"), ".cache", "docgen")
+    return path
+
+class Cache(object):
+    """
+    Persistent content-addressed cache with LRU eviction.
+
+    The string values are stored in files of the `name` subdirectory of
+    the cache directory; the keys are hashes computed by `Cache.key`.
+    When the total size exceeds `max_size` bytes, the least recently used 
+    entries are evicted. The `hits` and `misses` counters measure the cache 
+    efficiency.
+    """
+    def __init__(self, name, max_size=64 * 2**20):
+        root = cache_dir()
+        self.name = name
+        self.path = os.path.join(root, name) if root else None
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+
+    def __repr__(self):
+        return "Cache({0!r})".format(self.name)
+
+    @staticmethod
+    def key(*parts):
+        "Compute a key from a sequence of strings"
+        hash = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode("utf-8")
+            hash.update(str(len(part)) + ":" + part)
+        return hash.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        "Return the value associated to `key` or `None`"
+        if self.path is not None:
+            filename = self._filename(key)
+            try:
+                with open(filename, "rb") as file:
+                    value = file.read()
+                os.utime(filename, None) # mark as recently used
+                self.hits += 1
+                return value
+            except (IOError, OSError):
+                pass
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        "Associate `value` to `key`"
+        if self.path is None:
+            return
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        filename = self._filename(key)
+        try:
+            dirname = os.path.dirname(filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            import tempfile
+            fd, temp = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, "wb") as file:
+                file.write(value)
+            os.rename(temp, filename) # atomic
+        except (IOError, OSError):
+            return
+        if self._size is not None:
+            self._size += len(value)
+        if self._size is None or self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        "Evict the least recently used entries when the cache is too large"
+        entries = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        size = sum(entry[1] for entry in entries)
+        if size > self.max_size:
+            entries.sort()
+            target = 3 * self.max_size // 4
+            for _, entry_size, filename in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(filename)
+                    size -= entry_size
+                except OSError:
+                    pass
+        self._size = size
+
+    def clear(self):
+        "Remove all the cache entries"
+        if self.path is not None:
+            import shutil
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._size = 0
+
+    def disable(self):
+        "Disable the cache in the current process"
+        self.path = None
+
+    def stats(self):
+        "Return a one-line summary of the cache efficiency"
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        template = "{0} hits, {1} misses ({2:.1f}% hit rate)"
+        return template.format(self.hits, self.misses, rate)
+
+#
+# Profiling
+# ------------------------------------------------------------------------------
+#
+# When the profile is enabled (with `--profile`), docgen measures the wall 
+# time of its stages, the number of calls and the time spent in every
+# formatter, the number and the latency of the pandoc invocations and the 
+# peak memory usage. The times are self times: the time of a stage or of
+# a formatter excludes the time spent in the stages and formatters that run
+# within it, hence the stages add up to the total. The documentation is 
+# produced lazily, as it is rendered: the `render` stage only measures the
+# backend, not the stages that produce the chunks that it consumes; the 
+# `render/step` stages are the steps of the backend. The formatters are 
+# measured in the second formatting pass only, that produces the 
+# documentation; the first pass is measured as a whole, by its stage.
+#
+
+class Profile(object):
+    """
+    Measurements of a docgen run.
+
+    The measurements are recorded only when `enabled` is true.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.clear()
+
+    def __repr__(self):
+        return "Profile()"
+
+    def clear(self):
+        "Reset the measurements"
+        self.start = time.time()
+        self.stages = {}
+        self.order = []
+        self.formatters = {}
+        self.pandoc = []
+        self._stack = []
+
+    def enable(self):
+        "Reset the measurements and start recording"
+        self.clear()
+        self.enabled = True
+
+    def add(self, name, seconds):
+        "Add `seconds` to the wall time of the stage `name`"
+        if name not in self.stages:
+            self.order.append(name)
+            self.stages[name] = 0.0
+        self.stages[name] += seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure the self time of a `with` block as the stage `name`.
+
+        The block gets the `[start, nested]` entry of the stage: `nested` 
+        is the time (in seconds) excluded from the stage so far.
+        """
+        if not self.enabled:
+            yield None
+            return
+        entry = [time.time(), 0.0]
+        self._stack.append(entry)
+        try:
+            yield entry
+        finally:
+            self._stack.pop()
+            seconds = time.time() - entry[0]
+            self.add(name, seconds - entry[1])
+            if self._stack:
+                self._stack[-1][1] += seconds
+
+    def pandoc_call(self, seconds):
+        "Record a pandoc invocation that lasted `seconds`"
+        if self.enabled:
+            self.pandoc.append(seconds) # thread-safe
+
+    def iterate(self, name, function, *args):
+        """
+        Produce the chunks of `function(*args)` and measure the formatter 
+        `name`.
+
+        Only the time spent to produce the chunks is measured, not the time 
+        spent by the consumer of the chunks.
+        """
+        self.formatters.setdefault(name, [0, 0.0])[0] += 1
+        chunks = None
+        while True:
+            self._stack.append([time.time(), 0.0])
+            try:
+                if chunks is None:
+                    chunks = iter(function(*args))
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                start, nested = self._stack.pop()
+                seconds = time.time() - start
+                self.formatters[name][1] += seconds - nested
+                if self._stack:
+                    self._stack[-1][1] += seconds
+            yield chunk
+
+    def memory(self):
+        """
+        Return the peak memory usage of the process and of its children.
+
+        The sizes are in bytes; they are `None` when the `resource` module 
+        is not available.
+        """
+        try:
+            import resource
+        except ImportError:
+            return None, None
+        scale = 1 if sys.platform == "darwin" else 1024 # ru_maxrss unit
+        return [resource.getrusage(who).ru_maxrss * scale 
+                for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+
+    def report(self):
+        "Return the measurements as a JSON-compatible dict"
+        memory, children_memory = self.memory()
+        formatters = dict((name, {"calls": calls, "seconds": seconds}) 
+                          for name, (calls, seconds) in self.formatters.items())
+        caches = dict((cache.name, {"hits": cache.hits, "misses": cache.misses})
+                      for cache in _caches())
+        return {"total": time.time() - self.start,
+                "stages": [[name, self.stages[name]] for name in self.order],
+                "formatters": formatters,
+                "pandoc": {"calls": len(self.pandoc), 
+                           "seconds": sum(self.pandoc),
+                           "latencies": self.pandoc},
+                "memory": {"peak": memory, "children peak": children_memory},
+                "caches": caches}
+
+    def merge(self, report):
+        "Add the measurements of the `report` of another process"
+        for name, seconds in report["stages"]:
+            self.add(name, seconds)
+        for name, info in report["formatters"].items():
+            entry = self.formatters.setdefault(name, [0, 0.0])
+            entry[0] += info["calls"]
+            entry[1] += info["seconds"]
+        self.pandoc.extend(report["pandoc"]["latencies"])
+
+    def summary(self, report=None):
+        "Return a human-readable summary of a report (default: `report()`)"
+        if report is None:
+            report = self.report()
+        def MB(size):
+            return "n/a" if size is None else "{0:.1f} MB".format(size / 2.0**20)
+        memory = report["memory"]
+        lines = ["total: {0:.3f}s".format(report["total"]),
+                 "peak memory: {0} (children: {1})".format(
+                   MB(memory["peak"]), MB(memory["children peak"])),
+                 "stages:"]
+        for name, seconds in report["stages"]:
+            lines.append("  {0:<40} {1:8.3f}s".format(name, seconds))
+        lines.append("formatters (calls, self time):")
+        formatters = sorted(report["formatters"].items(), 
+                            key=lambda item: -item[1]["seconds"])
+        for name, info in formatters:
+            lines.append("  {0:<32} {1:7d} {2:8.3f}s".format(
+              name, info["calls"], info["seconds"]))
+        pandoc = report["pandoc"]
+        lines.append("pandoc: {0} calls, {1:.3f}s".format(pandoc["calls"], 
+                                                          pandoc["seconds"]))
+        for name, info in sorted(report["caches"].items()):
+            lines.append("{0} cache: {1} hits, {2} misses".format(
+              name, info["hits"], info["misses"]))
+        return "\n".join(lines)
+
+profile = Profile()
+
+#
+# Pandoc Workers
+# ------------------------------------------------------------------------------
+#
+
+# Rk: a pandoc (1.x) process converts a single document and then exits, so 
+#     there is no such thing as a persistent pandoc process. The long-lived
+#     workers of the pool are threads that feed pandoc subprocesses; what we
+#     gain is that independent conversions run concurrently.
+
+def _cpu_count():
+    # `multiprocessing.cpu_count` without the import of `multiprocessing`.
+    try:
+        count = os.sysconf("SC_NPROCESSORS_ONLN")
+    except (AttributeError, ValueError):
+        count = int(os.environ.get("NUMBER_OF_PROCESSORS", 0))
+    if count < 1:
+        import multiprocessing
+        count = multiprocessing.cpu_count()
+    return count
+
+class PandocPool(object):
+    """
+    Pool of pandoc workers.
+
+    The `size` of the pool defaults to the number of CPUs.
+    """
+    def __init__(self, size=None):
+        self._pool = None
+        self.resize(size)
+
+    def resize(self, size=None):
+        "Change the number of workers"
+        if size is None:
+            size = _cpu_count()
+        self.size = max(1, int(size))
+        self.close()
+
+    def close(self):
+        "Terminate the workers"
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def convert(self, text, **options):
+        "Convert `text` with pandoc"
+        import sh
+        return _convert(sh, text, options)
+
+    def map(self, texts, **options):
+        "Convert concurrently a list of texts with pandoc"
+        texts = list(texts)
+        if len(texts) <= 1 or self.size <= 1:
+            return [self.convert(text, **options) for text in texts]
+        # The workers do not import anything: the import lock may be held by
+        # the thread that waits for them (when docgen runs at import time).
+        import sh
+        if self._pool is None:
+            import multiprocessing.pool
+            self._pool = multiprocessing.pool.ThreadPool(self.size)
+        return self._pool.map(lambda text: _convert(sh, text, options), texts)
+
+def _convert(sh, text, options):
+    start = time.time()
+    output = str(sh.pandoc(_in=text, **options))
+    profile.pandoc_call(time.time() - start)
+    return output
+
+_pandoc_pool = PandocPool()
+
+_pandoc_version = None
+
+def pandoc_version():
+    "Return the pandoc version string"
+    global _pandoc_version
+    if _pandoc_version is None:
+        import sh
+        start = time.time()
+        _pandoc_version = str(sh.pandoc("--version")).split("\n")[0].strip()
+        profile.pandoc_call(time.time() - start)
+    return _pandoc_version
+
+pandoc_cache = Cache("pandoc")
+
+def pandoc_key(text, **options):
+    "Return the `pandoc_cache` key of a conversion"
+    options = " ".join("{0}={1}".format(*item) for item in sorted(options.items()))
+    return Cache.key(pandoc_version(), options, text)
+
+def pandoc(text, **options):
+    """
+    Convert `text` with pandoc.
+
+    The `options` are the pandoc command-line options. 
+    The results are stored in `pandoc_cache`.
+    """
+    key = pandoc_key(text, **options)
+    output = pandoc_cache.get(key)
+    if output is None:
+        output = _pandoc_pool.convert(text, **options)
+        pandoc_cache.set(key, output)
+    return output
+
 def read(text):
     """
     Read a markdown text as a Pandoc instance.
     """
-    #print "***text:", text
-    json_text = str(sh.pandoc(read="markdown", write="json", _in=text))
-    json_ = json.loads(json_text)
-    #import pprint
-    #pp = pprint.PrettyPrinter(indent=2).pprint
-    #print "***json:"
-    #pp(json_)
-    return to_pandoc(json_)
+    json_text = pandoc(text, read="markdown", write="json")
+    return read_json(json_text)
 
 def write(doc):
     """
     Write a Pandoc instance as a markdown text.
     """
     json_text = json.dumps(to_json(doc))
-    return str(sh.pandoc(read="json", write="markdown", _in=json_text))
+    return pandoc(json_text, read="json", write="markdown")
+
+#
+# **Remark:** the documentation of a module is made of many small fragments
+# (docstrings and Markdown comments). Converting them one by one spawns two
+# pandoc processes per fragment, so instead we join them in a single markdown
+# document, separated by an (HTML comment) delimiter, and split the result.
+# The fragments are distributed among the pandoc workers, so that there is 
+# at most one pandoc call per worker. The link reference definitions of a 
+# markdown document apply to the whole document, hence the fragments that
+# define link references are read separately: they would otherwise resolve 
+# the references of the other fragments of their batch. The same goes for 
+# the fragments with footnotes -- the markdown writer numbers them across 
+# the document and puts them at its end -- and for the fragments with a 
+# title block, that sets the metadata of the whole document.
+#
+
+FRAGMENT_DELIMITER = "<!-- docgen: fragment delimiter -->"
+
+_reference_definition = re.compile(r"^ {0,3}\[[^\]]+\]:", re.MULTILINE).search
+_footnote = re.compile(r"\[\^[^\]]+\]").search
+_title_block = re.compile(r"\s*%").match
+
+def _read_alone(text):
+    "Test if the markdown `text` cannot be read in a batch"
+    return bool(_reference_definition(text) or _footnote(text) or 
+                _title_block(text))
+
+def _write_alone(doc):
+    "Test if the Pandoc instance `doc` cannot be written in a batch"
+    meta = doc.args[0]
+    if isinstance(meta, dict) and any(meta.values()):
+        return True
+    Note = pandoc_type("Note")
+    return any(isinstance(node, Note) for node in _nodes(doc))
+
+def _chunks(items, n):
+    "Split `items` into at most `n` contiguous chunks"
+    size = -(-len(items) // n) or 1
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def _unique(items):
+    "Return the distinct `items`, in the order of their first occurrence"
+    seen, unique = set(), []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+    return unique
+
+def _read_many(texts):
+    # When the delimiters cannot be found back in a document, its texts 
+    # are read one by one.
+    separator = "\n\n" + FRAGMENT_DELIMITER + "\n\n"
+    batch = [text for text in texts if not _read_alone(text)]
+    chunks = _chunks(batch, _pandoc_pool.size)
+    chunks += [[text] for text in texts if _read_alone(text)]
+    jsons = _pandoc_pool.map([separator.join(chunk) for chunk in chunks], 
+                            read="markdown", write="json")
+    docs = {}
+    for chunk, json_text in zip(chunks, jsons):
+        doc = read_json(json_text)
+        meta, _docs, blocks = doc.args[0], [], []
+        for block in doc.args[1]:
+            if isinstance(block, RawBlock) and \
+               block.args[-1].strip() == FRAGMENT_DELIMITER:
+                _docs.append(Pandoc(meta, blocks))
+                blocks = []
+            else:
+                blocks.append(block)
+        _docs.append(Pandoc(meta, blocks))
+        if len(_docs) != len(chunk):
+            jsons = _pandoc_pool.map(chunk, read="markdown", write="json")
+            _docs = [read_json(json_text) for json_text in jsons]
+        docs.update(zip(chunk, _docs))
+    return [docs[text] for text in texts]
+
+def _write_many(docs):
+    batch = [doc for doc in docs if not _write_alone(doc)]
+    chunks = _chunks(batch, _pandoc_pool.size)
+    chunks += [[doc] for doc in docs if _write_alone(doc)]
+    json_texts = []
+    for chunk in chunks:
+        meta, blocks = chunk[0].args[0], []
+        for i, doc in enumerate(chunk):
+            if i:
+                blocks.append(RawBlock("html", FRAGMENT_DELIMITER))
+            blocks.extend(doc.args[1])
+        json_texts.append(json.dumps(to_json(Pandoc(meta, blocks))))
+    outputs = _pandoc_pool.map(json_texts, read="json", write="markdown")
+    texts = {}
+    for chunk, output in zip(chunks, outputs):
+        _texts = output.split(FRAGMENT_DELIMITER)
+        if len(_texts) != len(chunk):
+            _texts = [write(doc) for doc in chunk]
+        else:
+            _texts = [text.strip("\n") + "\n" for text in _texts]
+        texts.update(zip(map(id, chunk), _texts))
+    return [texts[id(doc)] for doc in docs]
+
+def read_many(texts):
+    """
+    Read a list of markdown texts as a list of Pandoc instances.
+
+    The results are stored in `pandoc_cache`, per text. For the texts that
+    are not in the cache, there is at most one pandoc call per worker.
+    """
+    texts = list(texts)
+    options = {"read": "markdown", "write": "json"}
+    # The "fragment" part of the keys discards the results of the former 
+    # batches, where link references could be resolved across fragments.
+    keys = [Cache.key("fragment", pandoc_key(text, **options)) 
+            for text in texts]
+    cached = [pandoc_cache.get(key) for key in keys]
+    missing = [text for text, json_text in zip(texts, cached) 
+               if json_text is None]
+    docs = iter(_read_many(missing))
+    results = []
+    for key, json_text in zip(keys, cached):
+        if json_text is None:
+            doc = next(docs)
+            pandoc_cache.set(key, json.dumps(to_json(doc)))
+        else:
+            doc = read_json(json_text)
+        results.append(doc)
+    return results
+
+def write_many(docs):
+    """
+    Write a list of Pandoc instances as a list of markdown texts.
+
+    The results are stored in `pandoc_cache`, per instance. For the 
+    instances that are not in the cache, there is at most one pandoc call 
+    per worker.
+    """
+    docs = list(docs)
+    options = {"read": "json", "write": "markdown"}
+    keys = [pandoc_key(json.dumps(to_json(doc)), **options) for doc in docs]
+    cached = [pandoc_cache.get(key) for key in keys]
+    missing = [doc for doc, text in zip(docs, cached) if text is None]
+    texts = iter(_write_many(missing))
+    results = []
+    for key, text in zip(keys, cached):
+        if text is None:
+            text = next(texts)
+            pandoc_cache.set(key, text)
+        results.append(text)
+    return results
 
 #
 # Pandoc Transforms
@@ -275,24 +999,104 @@ def apply(transform):
             transform(elt)
     return doc_transform
 
+class Transform(object):
+    """
+    Fused document transforms
+
+    A transform is a collection of actions registered for node types with 
+    `on` and of `finish` actions called once the document has been traversed.
+    Transforms combined with `+` are fused: all their actions are applied in
+    a single traversal of the document. The actions that apply to a node type 
+    are resolved once per type, not for every node.
+
+    In a fused transform, all the node actions are applied before the 
+    `finish` actions. This is the same as applying the transforms in turn,
+    unless the node actions of a transform come after the `finish` actions 
+    of another: `t1 + t2` raises a `ValueError` when `t1` has `finish` 
+    actions and `t2` has node actions.
+    """
+    def __init__(self, actions=None, finish=None):
+        self.actions = list(actions or [])
+        self.finish = list(finish or [])
+        self._dispatch = {}
+    def on(self, *types):
+        "Register an action for the instances of `types` (decorator)"
+        def register(action):
+            self.actions.append((types, action))
+            self._dispatch.clear()
+            return action
+        return register
+    def at_end(self, action):
+        "Register an action called at the end of the traversal (decorator)"
+        self.finish.append(action)
+        return action
+    def dispatch(self, type_):
+        "Return the actions that apply to the instances of `type_`"
+        try:
+            return self._dispatch[type_]
+        except KeyError:
+            actions = [action for types, action in self.actions 
+                       if issubclass(type_, types)]
+            self._dispatch[type_] = actions
+            return actions
+    def __add__(self, other):
+        if self.finish and other.actions:
+            raise ValueError("node actions fused after finish actions")
+        return Transform(self.actions + other.actions, 
+                         self.finish + other.finish)
+    def __call__(self, doc):
+        if self.actions:
+            dispatch = self._dispatch
+            for node in _nodes(doc):
+                try:
+                    actions = dispatch[type(node)]
+                except KeyError:
+                    actions = self.dispatch(type(node))
+                for action in actions:
+                    action(node)
+        for action in self.finish:
+            action()
+        if isinstance(doc, Pandoc):
+            doc._index = None
+        return doc
+
+def _shift(headers, delta):
+    for header in headers:
+        header.args = (header.args[0] + delta,) + header.args[1:]
+
+def header_shift(delta=1):
+    "Return a transform that increases the header levels by `delta`"
+    transform = Transform()
+    @transform.on(Header)
+    def shift(header):
+        _shift([header], delta)
+    return transform
+
+def min_header_level(minimum=1):
+    """
+    Return a transform that shifts the headers so that the minimum header 
+    level is at least `minimum`.
+
+    The headers are collected during the traversal and shifted at its end, 
+    hence the transform can be fused with others.
+    """
+    transform = Transform()
+    headers = []
+    transform.on(Header)(headers.append)
+    @transform.at_end
+    def shift():
+        if headers:
+            delta = minimum - min(header.args[0] for header in headers)
+            if delta > 0:
+                _shift(headers, delta)
+        del headers[:]
+    return transform
 
 def increase_header_level(doc, delta=1):
-    def _increase_header_level(delta):
-        def _increase(doc_item):
-            if isinstance(doc_item, Header):
-                doc_item.args[0] = doc_item.args[0] + delta
-        return _increase
-    return doc.apply(_increase_header_level(delta))
+    header_shift(delta)(doc)
 
 def set_min_header_level(doc, minimum=1):
-    levels = [item.args[0] for item in doc.iter() if isinstance(item, Header)]
-    if not levels:
-        return
-    else:
-        min_ = min(levels)
-        if minimum > min_:
-            delta = minimum - min_
-            increase_header_level(doc, delta)
+    min_header_level(minimum)(doc)
 
 #
 # **TODO:** insert HorizontalRule before every level 2 section. Unless I do that
@@ -300,6 +1104,127 @@ def set_min_header_level(doc, minimum=1):
 # and classes (no transform, do it directly during markdown generation) ?
 #
 
+#
+# Markdown Headers
+# ------------------------------------------------------------------------------
+#
+# Most fragments have no headers or only simple ATX/Setext headers, so the
+# header levels can be found and shifted directly in the markdown text,
+# without the pandoc round-trip. The analysis below is conservative: when a 
+# fragment has a construct that it cannot handle safely (raw HTML, block 
+# quotes, headers in lists, ambiguous paragraphs, etc.), the result is 
+# `None` and pandoc should be used instead. This is also the case of the 
+# fragments with link references, footnotes or a title block: copied as 
+# they are, their definitions would apply to the whole documentation.
+#
+
+_fence = re.compile(r"^(`{3,}|~{3,})")
+_list_item = re.compile(r"^ {0,3}(?:[-*+]|\d+[.)]|#\.)(?:[ \t]+|$)")
+_underline = re.compile(r"^(?:=+|-+)[ \t]*$")
+
+def find_headers(markdown):
+    """
+    Find the headers of a markdown text.
+
+    Return a list of `(start, end, level)` items where `start` and `end`
+    are the first and last line numbers (starting at `0`) of each header,
+    or `None` if the text cannot be analyzed safely.
+    """
+    if _read_alone(markdown): # document-wide definitions or title block
+        return None
+    lines = [line.expandtabs(4) for line in markdown.split("\n")]
+    headers = []
+    fence = None    # closing fence of the current fenced code block
+    code = False    # in an indented code block
+    in_list = False
+    blank = True    # the previous line is blank
+    para = None     # line number of the start of the current paragraph
+    for i, line in enumerate(lines):
+        content = line.lstrip(" ")
+        indent = len(line) - len(content)
+        headerish = content.startswith("#") or _underline.match(content)
+        if fence is not None:
+            if line.startswith(fence) and not line.strip().strip(fence[0]):
+                fence = None
+            continue
+        if not content.strip():
+            blank, para = True, None
+            continue
+        if indent >= 4:
+            if code or (blank and not in_list):
+                code = True
+            elif in_list and (headerish or content[0] in "<>"):
+                return None
+        else:
+            code = False
+            item = _list_item.match(line)
+            if in_list and blank and not item:
+                in_list = False
+            if content[0] in "<>":
+                return None
+            elif _fence.match(line):
+                if not blank:
+                    return None
+                fence = _fence.match(line).group(1)
+            elif item:
+                if not blank and not in_list: # no list item in a paragraph
+                    return None
+                rest = line[item.end():]
+                if rest.startswith("#") or _underline.match(rest):
+                    return None
+                in_list = True
+            elif in_list or (indent and headerish):
+                if headerish:
+                    return None
+            elif content.startswith("#"):
+                level = len(content) - len(content.lstrip("#"))
+                if not blank or level > 6:
+                    return None
+                headers.append((i, i, level))
+            elif _underline.match(content) and not blank:
+                if para != i - 1 or i + 1 < len(lines) and lines[i+1].strip():
+                    return None
+                headers.append((i - 1, i, 1 if content[0] == "=" else 2))
+            elif blank and not _underline.match(content):
+                para = i
+        blank = False
+    if fence is not None:
+        return None
+    return headers
+
+def header_levels(markdown):
+    """
+    Return the header levels of a markdown text or `None`.
+
+    See `find_headers`.
+    """
+    headers = find_headers(markdown)
+    if headers is not None:
+        return [level for _, _, level in headers]
+
+def shift_headers(markdown, minimum=1):
+    """
+    Set the minimal header level of a markdown text.
+
+    Return the new markdown text or `None` (see `find_headers`).
+    """
+    headers = find_headers(markdown)
+    if headers is None:
+        return None
+    delta = max(minimum - min([level for _, _, level in headers] or [0]), 0)
+    if not delta:
+        return markdown
+    lines = markdown.split("\n")
+    for start, end, level in reversed(headers):
+        if level + delta > 6:
+            return None
+        if start == end:
+            title = re.sub(r"^#+[ \t]*", "", lines[start])
+        else:
+            title = lines[start].strip()
+        lines[start:end+1] = [(level + delta) * "#" + " " + title]
+    return "\n".join(lines)
+
 #
 # ------------------------------------------------------------------------------
 #
@@ -328,16 +1253,30 @@ def get_star_imports(module):
             modules.append(match.groups()[0])
     return modules
 
+def star_import_index(module):
+    """
+    Index the objects star-imported by `module`.
+
+    Return the set of `(name, id(object))` pairs of the attributes of the
+    star-imported modules.
+    """
+    index = set()
+    for module_name in get_star_imports(module):
+        star_module = importlib.import_module(module_name)
+        for name, object in vars(star_module).items():
+            index.add((name, id(object)))
+    return index
+
 def is_external(item, name, star_imports):
+    """
+    Test if `item` (named `name`) is star-imported.
+
+    The `star_imports` argument is an index computed by `star_import_index`.
+    """
     last_name = name.split(".")[-1]
     if last_name.startswith("_") and not (last_name.startswith("__") and last_name.endswith("__")):
         return False
-    for module_name in star_imports:
-        module = importlib.import_module(module_name)
-        if hasattr(module, last_name) and getattr(module, last_name) is item:
-            return True
-    else:
-        return False
+    return (last_name, id(item)) in star_imports
 
 # TODO
 #   : when found an external module, register somewhere (for the dependency
@@ -346,7 +1285,7 @@ def is_external(item, name, star_imports):
 #   : need to find the star-imports and for every object that has no
 #     `__module__`, check that's there no such name in the star-imported
 #     modules.
-def object_tree(item, name=None, module=None, _cache=None):
+def object_tree(item, name=None, module=None, _cache=None, _star_imports=None):
     """
     Return the tree of items contained in `item`.
 
@@ -363,10 +1302,9 @@ def object_tree(item, name=None, module=None, _cache=None):
 
     tree = (name, item, [])
     if _cache is None:
-        _cache = ([], [])
-    if id(item) not in [id(x) for x in _cache[0]]:
-        _cache[0].append(item)
-        _cache[1].append(tree[2])
+        _cache = {} # id -> (item, children), the items are kept alive.
+    if id(item) not in _cache:
+        _cache[id(item)] = (item, tree[2])
     if isinstance(item, types.ModuleType):
         children = inspect.getmembers(item)
     elif isinstance(item, type):
@@ -382,7 +1320,8 @@ def object_tree(item, name=None, module=None, _cache=None):
         else:
             return True
 
-    star_imports = get_star_imports(module)
+    if _star_imports is None: # computed once per tree.
+        _star_imports = star_import_index(module)
 
     for _name, _item in children:
         # exclude private and foreign objects as well as (sub)modules.
@@ -394,7 +1333,7 @@ def object_tree(item, name=None, module=None, _cache=None):
         if (not _name.startswith("_") or (_name.startswith("__") and _name.endswith("__") and not _name in _hidden_magic)) and \
            not isinstance(_item, types.ModuleType) and \
            is_local(item, name) and \
-           not is_external(_item, _name, star_imports) and \
+           not is_external(_item, _name, _star_imports) and \
            not isinstance(_item, MethodWrapper):
            # import time; time.sleep(1.0)
            _name = name + "." + _name
@@ -403,11 +1342,10 @@ def object_tree(item, name=None, module=None, _cache=None):
            # BUG: Numpy issue: when an array is "=="'d to SOME items (such as 
            #      a numeric value, a boolean, etc.), the result is an array.
            
-           if id(_item) in [id(x) for x in _cache[0]]:
-               index = [id(x) for x in _cache[0]].index(id(_item))
-               new = (_name, _item, _cache[1][index])
+           if id(_item) in _cache:
+               new = (_name, _item, _cache[id(_item)][1])
            else:
-               new = object_tree(_item, _name, module, _cache)
+               new = object_tree(_item, _name, module, _cache, _star_imports)
            tree[2].append(new)
     return tree
 
@@ -490,8 +1428,10 @@ def signature(function, name=None):
 #    return comments
        
 def last_header_level(markdown):
-    doc = Pandoc.read(markdown)
-    levels = [item.args[0] for item in doc.iter() if isinstance(item, Header)]
+    levels = header_levels(markdown)
+    if levels is None:
+        doc = Pandoc.read(markdown)
+        levels = [header.args[0] for header in doc.find(Header)]
     if levels:
         return levels[-1]
 
@@ -521,41 +1461,6 @@ def last_header_level(markdown):
 #     return re.match(whitespace, line).group(0) == line
 
 
-# TODO: single function call, convert one way or another based on the
-#       number of arguments ? And therefore, turn the Locator into a 
-#       closure ...
-class Locator(object):
-    """Convert locations in text.
-
-    Locations are described either by
-    `offset`, an absolute character offset with respect to the
-    start of `text` 
-    or
-    a pair `(lineno, rel_offset)` of a line number offset
-    (starts at `0`) and an offset relative to the start of the line.
-    """
-    def __init__(self, text):
-        """
-        Create a `Locator` instance for the string `text`.
-        """
-        self._offsets = [0]
-        for line in text.split("\n"):
-            self._offsets.append(self._offsets[-1] + len(line) + 1)
-
-    def __call__(self, offset):
-        """
-        Compute the location `(lineno, rel_offset)`
-        """
-        for i, _offset in enumerate(self._offsets):
-            if offset < _offset:
-                return (i - 1, offset - self._offsets[i-1])
-
-    def offset(self, lineno, rel_offset):
-         """
-         Compute the location `offset`
-         """
-         return sum([len for len in self._offsets[:lineno]] + [rel_offset], 0)
-
 #
 # -----
 #
@@ -611,6 +1516,28 @@ def sort_items(list):
     first_then_longest = lambda item: (item[1], -item[2])
     list.sort(key=first_then_longest)
 
+_tokens = [
+    ("("        , r"(\()"),
+    ("["        , r"(\[)"),
+    ("{"        , r"(\{)"),
+    (")"        , r"(\))"),
+    ("]"        , r"(\])"),
+    ("}"        , r"(\})"),
+    ("BLANKLINE", r"(^[ \t\r\f\v]*\n)"),
+    ("COMMENT"  , r"([ \t\r\f\v]*#.*\n?(?:[ \t\r\f\v]*#.*\n?)*)"),
+    ("LINECONT" , r"(\\\n)"),
+    ("STRING"   , r'("(?:[^"]|\\")*")'),
+    ("STRING"   , r'("""(?:[^"]|\\"|"{1,2}(?!"))*""")'),
+    ("STRING"   , r"('(?: [^']|\\')*')"),
+    ("STRING"   , r"('''(?:[^']|\\'|'{1,2}(?!'))*''')"),
+]
+
+_token_patterns = [(_symbol, re.compile(_pattern, re.MULTILINE).match) 
+                   for _symbol, _pattern in _tokens]
+
+_token_search = re.compile("|".join(_pattern for _, _pattern in _tokens), 
+                           re.MULTILINE).search
+
 def tokenize(text):
     """
     Tokenizer
@@ -620,85 +1547,33 @@ def tokenize(text):
 
             (  )  [  ]  {  }  BLANKLINE  COMMENT  LINECONT  STRING
 
+    The patterns are searched in a single pass: the combined pattern finds 
+    the next token start and then the longest token that starts there 
+    is selected (the first one in the list of patterns in case of a tie).
     """
-    finders  = []
-    finders += [finder(symbol) for symbol in "( [ { ) ] }".split()]
-    finders += [finder("BLANKLINE", r"(^[ \t\r\f\v]*\n)", re.MULTILINE)]
-    finders += [finder("COMMENT"  , r"([ \t\r\f\v]*#.*\n?(?:[ \t\r\f\v]*#.*\n?)*)")]
-    finders += [finder("LINECONT" , r"(\\\n)")]
-    finders += [finder("STRING"   , r'("(?:[^"]|\\")*")')]
-    finders += [finder("STRING"   , r'("""(?:[^"]|\\"|"{1,2}(?!"))*""")')]
-    finders += [finder("STRING"   , r"('(?: [^']|\\')*')")]
-    finders += [finder("STRING"   , r"('''(?:[^']|\\'|'{1,2}(?!'))*''')")]
-
     start = 0
     items = []
     while start < len(text):
-        results = []
-        for find in finders:
-            result = find(text, start)
-            if result is not None:
-                results.append(result)
-        if results:
-            sort_items(results)
-            result = results[0]
-            items.append(result)
-            start = result[2]
-        else:
+        match = _token_search(text, start)
+        if match is None:
             break
-    return items
-
-# Rk: now the "largest" objects (enclosing braces) are returned AFTER the
-#     enclosed objects. Maybe we don't care ? But it's contrary to the
-#     classic linearization of the hierarchy.
-def scan(text):
-    """
-    Scan the source code `text` for atomic and scoping patterns.
-
-    Produce a a sequence of `(symbol, start, end)` items where `symbol` 
-    belongs to the following list of strings:
-
-            ()  []  {}  BLANKLINE  COMMENT  LINECONT  STRING
-
-    The items may be overlapping.
-    """
-    match = {"(": ")", "[": "]", "{": "}", ")": "(", "]": "[", "}": "{"}
-    wait_for = []
-    items = []
-
-    for symbol, start, end in tokenize(text):
-        if name in ["(", "[", "{"]:
-            wait_for.append((match[symbol], start))
-        elif wait_for and symbol == wait_for[-1][0]:
-            _, start = wait_for.pop()
-            items.append((match[symbol] + symbol, start, end))
-        else:
-            items.append((symbol, start, end))
-
-    sort_items(items)
+        start, result = match.start(), None
+        for symbol, pattern_match in _token_patterns:
+            match = pattern_match(text, start)
+            if match is not None and (result is None or match.end() > result[2]):
+                result = (symbol, start, match.end())
+        items.append(result)
+        start = result[2]
     return items
 
 def skip_lines(text):
     """
     Lines to skip during the indentation analysis.
     """
-    lines = []
-    locator = Locator(text)
-    for name, start, end in scan(text):
-        start, end = locator(start), locator(end)
-        if name == "BLANKLINE":
-            lines.append(start[0])
-        if name == "COMMENT":
-            start_line = start[0] + (start[1] != 0)
-            end_line = end[0] - 1
-            lines += [line for line in range(start_line, end_line + 1)]
-        if name == "LINECONT":
-            lines.append(start[0] + 1)
-        if name in "() [] {} STRING".split():
-            start_line = start[0] + 1
-            end_line = end[0]
-            lines += [line for line in range(start_line, end_line + 1)]
-    return set(lines)
+    skip = analyse(text, indents=False)[1]
+    return set(i for i, flag in enumerate(skip) if flag)
+
+_tab_search = re.compile("^[ \t\r\f\v]+", re.MULTILINE).search
 
 def tab_match(line, tabs):
     """
@@ -726,7 +1601,7 @@ def tab_match(line, tabs):
     A `ValueError` exception is raised if the `tabs` list is matched only 
     partially but there is some extra whitespace found after it.
     """
-    tab_search = re.compile("^[ \t\r\f\v]+", re.MULTILINE).search
+    tab_search = _tab_search
     _tabs = tabs[:]
     matched = []
 
@@ -749,6 +1624,65 @@ def tab_match(line, tabs):
     else:
         raise ValueError("indentation error")
 
+def analyse(text, indents=True):
+    """
+    Analyse the structure of the source code `text` in a single pass.
+
+    Returns
+    -------
+
+      - `indents`: the list of `(lineno, delta)` indents (see `indents`),
+        or `None` if `indents` is false,
+
+      - `skip`: a bitmap (`bytearray`) of the lines to skip during the 
+        indentation analysis (see `skip_lines`).
+
+    The tokens are located with a running line count and a line is 
+    analysed as soon as no later token can mark it as skipped.
+    """
+    lines = text.split("\n")
+    skip = bytearray(len(lines) + 1)
+    tabs, _indents = [], []
+    next = 0 # first line that has not been analysed yet
+    lineno, offset = 0, 0 # running line count
+
+    # The bracket tokens never span several lines and do not mark any line 
+    # (the former `scan` did not pair them, see `bench/reference.py`).
+    tokens = [token for token in tokenize(text) 
+              if token[0] not in "( ) [ ] { }".split()]
+    tokens.append((None, len(text), len(text)))
+    for symbol, start, end in tokens:
+        lineno += text.count("\n", offset, start)
+        offset = start
+        if indents:
+            stop = lineno if symbol is not None else len(lines)
+            for i in range(next, stop):
+                if not skip[i]:
+                    match, extra = tab_match(lines[i], tabs)
+                    if extra:
+                        _indents.append((i, +1))
+                        tabs.append(extra)
+                    else:
+                        _indents.append((i, len(match) - len(tabs)))
+                        del tabs[len(match):]
+            next = max(next, stop)
+        start_line = lineno
+        lineno += text.count("\n", offset, end)
+        offset = end
+        if symbol == "BLANKLINE":
+            skip[start_line] = 1
+        elif symbol == "COMMENT":
+            if start != 0 and text[start-1] != "\n":
+                start_line += 1
+            for i in range(start_line, lineno):
+                skip[i] = 1
+        elif symbol == "LINECONT":
+            skip[start_line + 1] = 1
+        elif symbol == "STRING":
+            for i in range(start_line + 1, lineno + 1):
+                skip[i] = 1
+    return (_indents if indents else None), skip
+
 def indents(text):
     """
     Return the indents of a source code.
@@ -759,19 +1693,7 @@ def indents(text):
 
       - `delta` is the number of extra indents (it may be negative).
     """
-    skip = skip_lines(text)
-    tabs = []
-    indents = []
-    for i, line in enumerate(text.split("\n")):
-        if i not in skip:
-            match, extra = tab_match(line, tabs)
-            if extra:
-                indents.append((i, +1))
-                tabs.append(extra)
-            else:
-                indents.append((i, len(match) - len(tabs)))
-                tabs = tabs[:len(match)]
-    return indents
+    return analyse(text)[0]
 
 def parse_declaration(line):
     finders  = []
@@ -791,6 +1713,107 @@ def parse_declaration(line):
     else:
         return None, None
 
+def _statements(module):
+    # Statements of a Python syntax tree, in source order.
+    stack = [module]
+    while stack:
+        node = stack.pop()
+        yield node
+        children = []
+        for field in ("body", "handlers", "orelse", "finalbody"):
+            value = getattr(node, field, None)
+            if isinstance(value, list): # not the body of exec statements
+                children.extend(value)
+        stack.extend(children[::-1])
+
+# The source is valid Python when this pattern is used: the string prefixes
+# and the tokens that cannot contain a newline or a bracket are ignored.
+_python_search = re.compile(r"""
+    '''(?:[^'\\]|\\.|'(?!''))*'''  |  \"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"
+  | '(?:[^'\\\n]|\\.)*'            |  "(?:[^"\\\n]|\\.)*"
+  | \#[^\n]*  |  \\\n  |  [(\[{]  |  [)\]}]  |  \n
+""", re.VERBOSE | re.DOTALL).search
+
+_python_start = re.compile(r"([ \t\f]*)([_a-zA-Z][_0-9a-zA-Z]*)?").match
+
+def parse_python(text):
+    """
+    Analyse a pure Python source code with the interpreter parser.
+
+    Returns
+    -------
+
+      - `indents`: the list of `(lineno, delta)` indents (see `indents`),
+
+      - `declarations`: a dictionary whose keys are line numbers and values
+        are `(type, name)` pairs (see `parse_declaration`).
+
+    Raises
+    ------
+
+    A `SyntaxError` exception is raised if the source code is not valid 
+    Python, for example Cython code.
+
+    The declarations come from the syntax tree. Once the source is known to
+    be valid, the logical lines are found by a scan of its strings, 
+    comments, brackets and line continuations.
+    """
+    try:
+        module = compile(text, "<source>", "exec", ast.PyCF_ONLY_AST)
+    except TypeError, error: # null bytes
+        raise SyntaxError(str(error))
+    definitions, assignments = [], {}
+    for node in _statements(module):
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            definitions.append(node)
+        elif isinstance(node, ast.Assign) and \
+             isinstance(node.targets[0], ast.Name):
+            assignments.setdefault(node.lineno - 1, node.targets[0].id)
+    definitions = iter(definitions)
+
+    indents, declarations = [], {}
+    tabs = [0]
+    depth, lineno, start = 0, 0, 0
+    while start is not None:
+        match = _python_start(text, start)
+        end = match.end(1)
+        if start == len(text):
+            indents.append((lineno, 1 - len(tabs))) # last (empty) line
+        elif end < len(text) and text[end] not in "#\r\n":
+            column = len(match.group(1).expandtabs(8))
+            if column > tabs[-1]:
+                tabs.append(column)
+                delta = +1
+            else:
+                delta = 0
+                while column < tabs[-1]:
+                    tabs.pop()
+                    delta -= 1
+            indents.append((lineno, delta))
+            name = match.group(2)
+            if name in ("def", "class"):
+                type = "function" if name == "def" else "class"
+                declarations[lineno] = (type, next(definitions).name)
+            elif name is not None and assignments.get(lineno) == name:
+                declarations[lineno] = ("assignment", name)
+        # Find the start of the next logical line.
+        next_start = None
+        match = _python_search(text, start)
+        while match is not None:
+            symbol = match.group(0)
+            if symbol == "\n" and depth == 0:
+                next_start = match.end()
+                break
+            elif symbol in ("(", "[", "{"):
+                depth += 1
+            elif symbol in (")", "]", "}"):
+                depth -= 1
+            match = _python_search(text, match.end())
+        if next_start is not None:
+            lineno += text.count("\n", start, next_start)
+        start = next_start
+    return indents, declarations
+
 # ------------------------------------------------------------------------------
 # TODO: tree (or make_tree) function that produces a [lineno, info, children]
 #       (or even [info, children] ?) hierarchical structure. All the relevant
@@ -854,7 +1877,17 @@ def make_tree(text):
           - `info` has `lineno`, `name`, `type` and `source` attributes, 
           - `children` is a list of `tree` items.
 
+    The source structure is analysed with the interpreter parser (see 
+    `parse_python`) when the source code is valid Python; otherwise 
+    -- for example for Cython code -- the regular expression based analysis
+    is used (see `indents` and `parse_declaration`).
     """
+    try:
+        with profile.stage("make_tree/parse_python"):
+            _indents, declarations = parse_python(text)
+    except SyntaxError:
+        with profile.stage("make_tree/tokenize"):
+            _indents, declarations = indents(text), None
     lines = text.split("\n")
     items = [(Info(lineno=0, name=None, type=None), [])]
     item = items[0] # current item
@@ -864,10 +1897,13 @@ def make_tree(text):
     def fold():
         item = items.pop()
         items[-1][-1].append(item)
-    for lineno, tab in indents(text):
+    for lineno, tab in _indents:
         text = "\n".join(lines[prev_lineno:lineno])
         item[0].source = text
-        type, name = parse_declaration(lines[lineno])
+        if declarations is None:
+            type, name = parse_declaration(lines[lineno])
+        else:
+            type, name = declarations.get(lineno, (None, None))
         if tab <= 0 and len(items) >= 2:
             for _ in range(-tab + 1):
                 fold()
@@ -909,24 +1945,121 @@ def display_tree(tree, nest=""):
 #
 
 
+class Conversions(object):
+    """
+    Batched Markdown conversions of a module documentation.
+
+    The headers of most fragments (docstrings and Markdown comments) are 
+    handled directly in the markdown text (see `find_headers`); the other 
+    fragments are read with a single pandoc call. The formatters request the 
+    conversion of docstrings with a minimal header level; the requests that
+    need pandoc are collected during a first formatting pass, then written 
+    with a single pandoc call by `flush`, and their results are available to 
+    the next formatting pass.
+    """
+    def __init__(self, fragments=()):
+        fragments = [fragment for fragment in _unique(fragments)
+                     if find_headers(fragment) is None]
+        self.docs = dict(zip(fragments, read_many(fragments)))
+        self.requests = []
+        self._requested = set()
+        self.results = {}
+        self.misses = 0
+
+    def doc(self, markdown):
+        "Return the (shared) Pandoc instance of a fragment"
+        if markdown not in self.docs:
+            self.docs[markdown] = Pandoc.read(markdown)
+        return self.docs[markdown]
+
+    def header_levels(self, markdown):
+        "Return the header levels of a fragment"
+        levels = header_levels(markdown)
+        if levels is not None:
+            return levels
+        return [header.args[0] for header in self.doc(markdown).find(Header)]
+
+    def convert(self, markdown, level):
+        """
+        Return `markdown` with a minimal header level of `level`.
+
+        Until the next `flush`, unknown conversions are registered and 
+        `markdown` is returned unchanged; the `misses` counter is 
+        incremented.
+        """
+        key = (markdown, level)
+        if key in self.results:
+            return self.results[key]
+        text = shift_headers(markdown, level)
+        if text is not None:
+            self.results[key] = text.rstrip("\n") + "\n"
+            return self.results[key]
+        if key not in self._requested:
+            self._requested.add(key)
+            self.requests.append(key)
+        self.misses += 1
+        return markdown
+
+    def flush(self):
+        "Perform the pending conversions"
+        import copy
+        docs = []
+        for markdown, level in self.requests:
+            doc = copy.deepcopy(self.doc(markdown))
+            set_min_header_level(doc, level)
+            docs.append(doc)
+        self.results.update(zip(self.requests, write_many(docs)))
+        self.requests = []
+        self._requested.clear()
+
+def fragments(tree):
+    """
+    Return the docstrings and Markdown comments found in `tree`.
+    """
+    object = getattr(tree[0], "object", None)
+    if isinstance(object, Markdown):
+        yield str(object)
+    elif isinstance(object, tuple(FunctionTypes) + (type,)):
+        docstring = inspect.getdoc(object)
+        if docstring:
+            yield docstring
+    for child in tree[1]:
+        for fragment in fragments(child):
+            yield fragment
+
 # TODO: manage the body of docgen as yet another formatter function.
 
-def docgen(module, source, debug=False):
+def docgen(module, source, debug=False, incremental=False, filename=None):
+    """
+    Return the markdown documentation of `module` whose source is `source`.
+
+    See `iter_docgen`.
+    """
+    return "".join(iter_docgen(module, source, debug, incremental, filename))
+
+def iter_docgen(module, source, debug=False, incremental=False, filename=None):
+    """
+    Produce the markdown documentation of `module` as a sequence of chunks.
+
+    The source tree is read from `parse_cache` when the source file 
+    `filename` has not changed (see `source_tree`).
+
+    In `incremental` mode, the documentation of the nodes of the source tree
+    is stored in `render_cache` and the unchanged nodes are not formatted
+    again.
+    """
     module_name = module.__name__
-    tree = make_tree(source)
+    tree = source_tree(source, filename)
     tree[0].name = module_name
 
-    objectify(tree)
-    commentify(tree)
-    decoratify(tree)
+    with profile.stage("objectify"):
+        objectify(tree)
 
     if debug:
         display_tree(tree)
         print 5*"\n"
 
 
-    markdown = ""
-
     docstring = inspect.getdoc(module) or ""
     doclines = docstring.split("\n")
     if len(doclines) == 1:
@@ -937,22 +2070,54 @@ def docgen(module, source, debug=False):
         short, long = "\n".join(doclines)
 
 
-    # TODO: refactor into `format_module`.
-    markdown  = "#" + " " + tt(module_name)
-    markdown += (" -- " + short + "\n\n") if short else "\n\n"
-    markdown += long + "\n\n" if long else ""
-
     level = 2
 
-    state = {"level": level, 
-             "namespace": module_name, 
-             "restore": True}
+    with profile.stage("pandoc read"):
+        conversions = Conversions(fragments(tree))
+
+    def new_state():
+        return {"level": level, 
+                "namespace": module_name, 
+                "restore": True,
+                "conversions": conversions,
+                "cache": render_cache if incremental else None}
+
+    # The first pass only collects the conversion requests.
+    state = new_state()
+    state["profile"] = False # the formatters are measured in the second pass
+    with profile.stage("format (first pass)"):
+        for child in tree[1]:
+            for _ in iter_format(child, state):
+                pass
+    with profile.stage("pandoc write"):
+        conversions.flush()
 
+    # TODO: refactor into `format_module`.
+    yield "#" + " " + tt(module_name)
+    yield (" -- " + short + "\n\n") if short else "\n\n"
+    yield long + "\n\n" if long else ""
+
+    # The render cache is queried again by the second pass: only the queries
+    # of the first pass are counted.
+    counters = render_cache.hits, render_cache.misses
+    state = new_state()
     for child in tree[1]:
-        markdown += format(child, state)
+        for chunk in iter_format(child, state):
+            yield chunk
+    render_cache.hits, render_cache.misses = counters
+
 
-    return markdown
+_failed_imports = set()
 
+def _import(name):
+    # Import a module or return None; the failures are memoized.
+    if name in _failed_imports:
+        return None
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        _failed_imports.add(name)
+        return None
 
 def load_object(qualified_name):
     """
@@ -964,11 +2129,11 @@ def load_object(qualified_name):
     while parts:
         part = parts.pop(0)
         base = (base + "." if base else "") + part
-        try: 
-            object = importlib.import_module(base)
-        except ImportError:
+        module = _import(base)
+        if module is None:
             parts.insert(0, part)
             break
+        object = module
     if object is None:
        raise ValueError()
     for part in parts:
@@ -978,11 +2143,28 @@ def load_object(qualified_name):
            raise ValueError()
     return object
 
+def _load_child(parent, qname, name):
+    # Same result as `load_object(qname + "." + name)` given the parent 
+    # object loaded from `qname`: only a module may have a submodule.
+    if isinstance(parent, types.ModuleType):
+        child_qname = qname + "." + name
+        module = sys.modules.get(child_qname)
+        if module is None and hasattr(parent, "__path__"):
+            module = _import(child_qname)
+        if module is not None:
+            return module
+    try:
+        return getattr(parent, name)
+    except AttributeError:
+        raise ValueError()
+
 def objectify(tree, ns=None):
     """
     Annotate a tree with objects instances.
 
     Add `object` fields to the tree `info` structures when it makes sense.
+    The root object is loaded by name, the other objects are found in their
+    parent object.
     """
     name = tree[0].name
     if name:
@@ -990,9 +2172,18 @@ def objectify(tree, ns=None):
         try:
             tree[0].object = load_object(qname)
         except ValueError:
-            pass
-        for child in tree[1]:
-            objectify(child, ns=qname)
+            return
+        stack = [(tree, qname)]
+        while stack:
+            (info, children), qname = stack.pop()
+            for child in children:
+                name = child[0].name
+                if name:
+                    try:
+                        child[0].object = _load_child(info.object, qname, name)
+                    except ValueError:
+                        continue
+                    stack.append((child, qname + "." + name))
 
 
 
@@ -1007,31 +2198,10 @@ class Markdown(object):
         lines = [line[2:] for line in lines[1:-1]]
         return Markdown("\n".join(lines) + "\n")
 
-def commentify(tree):
-    source = getattr(tree[0], "source", None)
-    object = getattr(tree[0], "object", None)
-    if source is not None and (object is None or not isinstance(object, Markdown)):
-        # Oh, c'mon, use the tokenizer ffs !
-        pattern = r"^#\s*\n(?:#(?: [^\n]*|[ \t\r\f\v]*)\n)*#\s*(\n|$)"
-        matches = list(re.finditer(pattern, source, re.MULTILINE))
-        for i, match in enumerate(matches):
-            start = match.start()
-            end = match.end()
-            if i == 0:
-                tree[0].source = source[:start]
-            if i+1 < len(matches):
-                next = matches[i+1].start()
-            else:
-                next = len(source)
-            comment = Markdown.from_comment(source[start:end])
-            line_start = source.count("\n", 0, start)
-            info = Info(name=None, lineno=tree[0].lineno + line_start, 
-                        object=comment, type=None)
-            info.source = source[start:next]
-            tree[1].insert(i, (info, []))
+_comment_pattern = re.compile(
+  r"^#\s*\n(?:#(?: [^\n]*|[ \t\r\f\v]*)\n)*#\s*(\n|$)", re.MULTILINE)
 
-    for child in tree[1]:
-        commentify(child)
+_decorator_pattern = re.compile(r"^\s*@.+(\n|$)", re.MULTILINE)
 
 # TODO: decoratorify, then implement the corresponding formatter ? Oops,
 #       slightly more complex as u have to modify a function formatter.
@@ -1045,37 +2215,266 @@ class Decorator(object):
 
 # TODO: avoid the regexp in COMMENT or STRING content (re-scan the content,
 #       based on finders instead of the raw regexp)
-def decoratify(tree):
-    source = getattr(tree[0], "source", None)
-    object = getattr(tree[0], "object", None)
-    if source is not None and (object is None or not isinstance(object, Decorator)):
-        pattern = r"^\s*@.+(\n|$)"
-        matches = list(re.finditer(pattern, source, re.MULTILINE))
-        for i, match in enumerate(matches):
-            start = match.start()
-            end = match.end()
-            if i == 0:
-                tree[0].source = source[:start]
-            if i+1 < len(matches):
-                next = matches[i+1].start()
-            else:
-                next = len(source)
-            decorator = Decorator(source[start:end].strip())
-            line_start = source.count("\n", 0, start)
-            info = Info(name=None, lineno=tree[0].lineno + line_start, 
-                        object=decorator, type=None)
-            info.source = source[start:next]
-            tree[1].insert(i, (info, []))
+def annotate(tree):
+    """
+    Extract the markdown comments and the decorators of a tree.
 
-    for child in tree[1]:
-        decoratify(child)
+    The decorators and then the comments found in the source of a node 
+    are inserted before its children; a comment node owns the source up to
+    the next comment, with its decorators. The tree is traversed once, 
+    every source is searched once per pattern and the line numbers are 
+    counted incrementally.
+    """
+    stack = [tree]
+    while stack:
+        info, children = stack.pop()
+        stack.extend(children)
+        source = getattr(info, "source", None)
+        object = getattr(info, "object", None)
+        if source is None or isinstance(object, (Markdown, Decorator)):
+            continue
+        comments = list(_comment_pattern.finditer(source))
+        decorators = list(_decorator_pattern.finditer(source))
+        if not comments and not decorators:
+            continue
+
+        linenos = {}
+        lineno, offset = info.lineno, 0
+        for start in sorted([match.start() for match in comments] + 
+                            [match.start() for match in decorators]):
+            lineno += source.count("\n", offset, start)
+            linenos[start], offset = lineno, start
+
+        # The comments split the source into segments: the first one belongs
+        # to the node, the other ones to the comment nodes. The decorators 
+        # found in a segment become the children of its node.
+        bounds = [0] + [match.start() for match in comments] + [len(source)]
+        nodes = [(info, [])]
+        for match in comments:
+            start, end = match.start(), match.end()
+            comment = Markdown.from_comment(source[start:end])
+            nodes.append((Info(name=None, lineno=linenos[start], 
+                               object=comment, type=None), []))
+        segments = [[] for _ in nodes]
+        segment = 0
+        for match in decorators:
+            while match.start() >= bounds[segment + 1]:
+                segment += 1
+            segments[segment].append(match)
+        for segment, (node, matches) in enumerate(zip(nodes, segments)):
+            starts = [match.start() for match in matches]
+            ends = starts[1:] + [bounds[segment + 1]]
+            node[0].source = source[bounds[segment]:(starts + ends)[0]]
+            for match, end in zip(matches, ends):
+                start = match.start()
+                decorator = Decorator(source[start:match.end()].strip())
+                child = Info(name=None, lineno=linenos[start], 
+                             object=decorator, type=None)
+                child.source = source[start:end]
+                node[1].append((child, []))
+        children[:0] = nodes[0][1] + nodes[1:]
+
+#
+# Source Tree Cache
+# ------------------------------------------------------------------------------
+#
+# The source tree -- with its markdown comments and decorators -- is stored
+# in `parse_cache`, so that the syntax analysis of unchanged source files is
+# not done again. The objects are loaded afterwards by `objectify`.
+#
+
+parse_cache = Cache("parse")
+
+def _encode_tree(tree):
+    info, children = tree
+    object = getattr(info, "object", None)
+    if isinstance(object, Markdown):
+        kind, value = "markdown", object.markdown
+    elif isinstance(object, Decorator):
+        kind, value = "decorator", object.decorator
+    else:
+        kind, value = None, None
+    return (info.lineno, info.name, info.type, getattr(info, "source", None),
+            kind, value, [_encode_tree(child) for child in children])
+
+def _decode_tree(data):
+    lineno, name, type, source, kind, value, children = data
+    info = Info(lineno=lineno, name=name, type=type)
+    if source is not None:
+        info.source = source
+    if kind == "markdown":
+        info.object = Markdown(value)
+    elif kind == "decorator":
+        info.object = Decorator(value)
+    return (info, [_decode_tree(child) for child in children])
+
+def source_tree(source, filename=None):
+    """
+    Return the tree of the source code `source`, with its markdown comments
+    and decorators.
+
+    The tree is stored in `parse_cache`, in `marshal` format; the key 
+    depends on the path, size and modification time of `filename` and on 
+    the hash of `source`.
+    """
+    stat = ["", "", ""]
+    if filename is not None:
+        try:
+            info = os.stat(filename)
+            stat = [os.path.abspath(filename), str(info.st_size), 
+                    repr(info.st_mtime)]
+        except OSError:
+            pass
+    if isinstance(source, unicode):
+        digest = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    else:
+        digest = hashlib.sha1(source).hexdigest()
+    key = Cache.key(formatter_version(), sys.version, *stat + [digest])
+    with profile.stage("parse cache"):
+        data = parse_cache.get(key)
+        if data is not None:
+            try:
+                return _decode_tree(marshal.loads(data))
+            except (EOFError, ValueError, TypeError):
+                pass
+    with profile.stage("make_tree"):
+        tree = make_tree(source)
+    with profile.stage("annotate"):
+        annotate(tree)
+    parse_cache.set(key, marshal.dumps(_encode_tree(tree)))
+    return tree
 
 _formatters = []
 
 def is_public(name):
    return not name.startswith("_") or (name.startswith("__") and name.endswith("__"))
 
+#
+# Incremental Builds
+# ------------------------------------------------------------------------------
+#
+# When the state has a `"cache"` entry, the `format` function stores the 
+# markdown of every node in the cache, with the state that results from its
+# formatting. The key of a node depends on its *fingerprint* and on the 
+# state before formatting, so the nodes that did not change since the last 
+# build are not formatted again.
+#
+
+_formatter_version = None
+
+def formatter_version():
+    "Return a hash of the formatting code"
+    global _formatter_version
+    if _formatter_version is None:
+        try:
+            source = inspect.getsource(sys.modules[__name__])
+        except (IOError, TypeError):
+            source = ""
+        _formatter_version = Cache.key(__version__, source)
+    return _formatter_version
+
+def fingerprint(tree):
+    """
+    Compute the fingerprint of a tree.
+
+    The fingerprint depends on the formatting code, on the pandoc version and
+    on the name, type, source, object and docstring of every node of the tree.
+    """
+    info = tree[0]
+    if getattr(info, "fingerprint", None) is None:
+        object = getattr(info, "object", None)
+        if isinstance(object, tuple(FunctionTypes)):
+            summary = inspect.getdoc(object) or ""
+        elif isinstance(object, type):
+            bases_names = [base.__name__ for base in object.__bases__]
+            summary = (inspect.getdoc(object) or "") + repr(bases_names)
+        elif info.name and not is_public(info.name):
+            summary = "" # the value is not documented.
+        elif isinstance(object, unicode):
+            summary = object.encode("utf-8")
+        else:
+            try:
+                summary = str(object)
+            except Exception:
+                summary = repr(type(object))
+        parts = [formatter_version(), pandoc_version(), 
+                 repr(info.name), repr(info.type), 
+                 getattr(info, "source", None) or "", type(object).__name__,
+                 summary]
+        parts += [fingerprint(child) for child in tree[1]]
+        info.fingerprint = Cache.key(*parts)
+    return info.fingerprint
+
+render_cache = Cache("render")
+
+_services = ["conversions", "cache", "record", "profile"] # state entries that are not data.
+
+def _snapshot(state, ignore=()):
+    ignore = set(_services) | set(ignore)
+    data = dict((key, state[key]) for key in state if key not in ignore)
+    return json.dumps(data, sort_keys=True)
+
 def format(tree, state):
+    """
+    Format `tree` as markdown, with the formatter registered for its object.
+
+    See `iter_format` and `formatter`.
+    """
+    return "".join(iter_format(tree, state))
+
+def iter_format(tree, state):
+    """
+    Format `tree` as a sequence of markdown chunks.
+
+    The state is updated as the chunks are produced: the sequence shall be
+    consumed entirely before the formatting of the next tree.
+    """
+    cache = state.get("cache")
+    if cache is None:
+        for chunk in _format(tree, state):
+            yield chunk
+        return
+    key = Cache.key(fingerprint(tree), _snapshot(state, ignore=["restore"]))
+    value = cache.get(key)
+    if value is not None:
+        data, markdown = value.split("\n", 1)
+        data = json.loads(data)
+        if data.pop("__unicode__", False):
+            markdown = markdown.decode("utf-8")
+        for name in state.keys():
+            if name not in _services and name not in data:
+                del state[name]
+        state.update(data)
+        yield markdown
+        return
+    conversions = state.get("conversions")
+    misses = conversions.misses if conversions else 0
+    # The chunks are recorded once, by the outermost node, in the shared 
+    # `"record"` list; the nested nodes only remember their slice.
+    record = state.get("record")
+    outer = record is None
+    if outer:
+        record = state["record"] = []
+    begin = len(record)
+    try:
+        for chunk in _format(tree, state):
+            if outer:
+                record.append(chunk)
+            yield chunk
+    finally:
+        if outer:
+            del state["record"]
+    if not conversions or conversions.misses == misses: # final markdown
+        markdown = "".join(record[begin:])
+        data = json.loads(_snapshot(state))
+        if isinstance(markdown, unicode):
+            data["__unicode__"] = True
+            value = markdown.encode("utf-8")
+        else:
+            value = markdown
+        cache.set(key, json.dumps(data) + "\n" + value)
+
+def _format(tree, state):
     _match = False
     for types, formatter in _formatters:
         if not types:
@@ -1088,9 +2487,24 @@ def format(tree, state):
                 pass
         if _match:
             state["restore"] = True
+            if profile.enabled and state.get("profile", True):
+                return profile.iterate(formatter.__name__, formatter, tree, state)
             return formatter(tree, state)
+    return []
+
+def _format_children(tree, state):
+    for child in tree[1]:
+        for chunk in iter_format(child, state):
+            yield chunk
 
 def formatter(*types):
+    """
+    Register a formatter for the objects of the given types.
+
+    A formatter is called with a `tree` and a `state` and returns an
+    iterable of markdown chunks (usually, it is a generator).
+    The formatter registered without types is the default one.
+    """
     def register(formatter):
         _formatters.append((types, formatter))
         return formatter
@@ -1108,10 +2522,9 @@ FunctionTypes = [types.FunctionType,
 @formatter(*FunctionTypes)
 def format_function(tree, state):
 
-    markdown = ""
     if is_public(tree[0].name):
         object = tree[0].object
-        markdown  = state["level"] * "#" + " "
+        yield state["level"] * "#" + " "
 
         # TODO: syntax-based signature (instead of introspection-based)
         # Quick and dirty. Need something more robust that will used multiline,
@@ -1121,7 +2534,7 @@ def format_function(tree, state):
         # TODO: handle assignment.
         assignment = re.compile(r"\s*([_a-zA-Z])+\s*=")
         if assignment.match(source):
-            markdown += tt(source.split("\n")[0].strip()) + " [`function`]\n"
+            yield tt(source.split("\n")[0].strip()) + " [`function`]\n"
         else:
             def_ = re.compile(r"\s*(?:c|cp)?def\s+(.+)$", re.MULTILINE)
             match = def_.match(source)
@@ -1131,67 +2544,60 @@ def format_function(tree, state):
 
             signature = match.group(1).strip()[:-1]
 
-            markdown += tt(signature)
+            yield tt(signature)
 
-            markdown += " [`function`]\n"
-            markdown += "\n"
+            yield " [`function`]\n"
+            yield "\n"
 
             decorators = state.get("decorator", [])
             if len(decorators) == 1:
-                markdown += "decorated by: "
-                markdown += tt(decorators[0]) + ".\n\n"
+                yield "decorated by: "
+                yield tt(decorators[0]) + ".\n\n"
             elif len(decorators) >= 2:
-                markdown += "decorated by:\n\n"
+                yield "decorated by:\n\n"
                 for decorator in decorators:
-                    markdown += "  - " + tt(decorator) + "\n"
-                markdown += "\n"
+                    yield "  - " + tt(decorator) + "\n"
+                yield "\n"
 
             docstring = inspect.getdoc(object) or ""
             if docstring:
-                doc = Pandoc.read(docstring)
-                set_min_header_level(doc, state["level"] + 1)
-                docstring = doc.write()
-                markdown += docstring + "\n\n"
+                conversions = state["conversions"]
+                docstring = conversions.convert(docstring, state["level"] + 1)
+                yield docstring + "\n\n"
 
     state["decorator"] = []
 
     if is_public(tree[0].name):
         level = state["level"]
         state["level"] = level + 1
-        for child in tree[1]:
-            markdown += format(child, state)
+        for chunk in _format_children(tree, state):
+            yield chunk
         if state["restore"]:
             state["level"] = level
 
-    return markdown
-
 # TODO: recursivity. Beware: the comments should be 
 # intertwined. The most basic solution would duplicate
 # the comment management code. Can we do better ?
 @formatter(type)
 def format_type(tree, state):
-    markdown = ""
     if is_public(tree[0].name):
         object = tree[0].object
         name = tree[0].name
         level = state["level"]
-        markdown  = level * "#" + " "
+        yield level * "#" + " "
         bases_names = [type.__name__ for type in object.__bases__] 
-        markdown += tt((name + "({0})").format(", ".join(bases_names))) 
-        markdown += " [`type`]\n"
-        markdown += "\n"
+        yield tt((name + "({0})").format(", ".join(bases_names))) 
+        yield " [`type`]\n"
+        yield "\n"
         docstring = inspect.getdoc(object) or ""
         if docstring:
-            doc = Pandoc.read(docstring)
-            set_min_header_level(doc, level + 1)
-            docstring = doc.write()
-            markdown += docstring + "\n"
+            docstring = state["conversions"].convert(docstring, level + 1)
+            yield docstring + "\n"
         state["level"] = level + 1
-        for child in tree[1]:
-            markdown += format(child, state)
+        for chunk in _format_children(tree, state):
+            yield chunk
         if state["restore"]:
             state["level"] = level
-    return markdown
 
 
 
@@ -1202,8 +2608,7 @@ def format_markdown(tree, state):
 
     #print "***", markdown
 
-    doc = Pandoc.read(markdown)
-    levels = [item.args[0] for item in doc.iter() if isinstance(item, Header)]
+    levels = state["conversions"].header_levels(markdown)
     if levels:
         state["level"] = levels[-1] + 1
         state["restore"] = False # disable the parent(s) level restore.
@@ -1216,7 +2621,7 @@ def format_markdown(tree, state):
     #      this change AND replace the state copy replaces with a share/restore
     #      feat. ? Study how this option would interact with comments (not very
     #      well AFAICT).
-    return markdown
+    yield markdown
 
 @formatter(Decorator)
 def format_decorator(tree, state):
@@ -1224,17 +2629,16 @@ def format_decorator(tree, state):
     if not state.get("decorator", None):
         state["decorator"] = []
     state["decorator"].append(tree[0].object.decorator)
-    return ""
+    return []
 
 @formatter(object)
 def format_object(tree, state):
-    markdown = ""
     if is_public(tree[0].name):
         object = tree[0].object
         name = tree[0].name
-        markdown  = state["level"] * "#" + " " + tt(name) 
-        markdown += " [`{0}`] \n".format(type(object).__name__)
-        markdown += "\n"
+        yield state["level"] * "#" + " " + tt(name) 
+        yield " [`{0}`] \n".format(type(object).__name__)
+        yield "\n"
         if isinstance(object, unicode):
             string = object.encode("utf-8")
         else:
@@ -1242,25 +2646,22 @@ def format_object(tree, state):
         if len(string) >= 800:
             string = string[:400] + " ... " + string[-400:]
 
-        markdown += tt(string) + "\n\n"
+        yield tt(string) + "\n\n"
         level = state["level"]
         state["level"] = level + 1
-        for child in tree[1]:
-            markdown += format(child, state)
+        for chunk in _format_children(tree, state):
+            yield chunk
         if state["restore"]:
             state["level"] = level
-    return markdown
 
 @formatter()
 def format_default(tree, state):
-    markdown = ""
     level = state["level"]
     state["level"] = level + 1
-    for child in tree[1]:
-        markdown += format(child, state)
+    for chunk in _format_children(tree, state):
+        yield chunk
     if state["restore"]:
         state["level"] = level
-    return markdown
 
 
 
@@ -1369,72 +2770,762 @@ def format_default(tree, state):
 #        markdown += format(item, name, level+1, module, comments) + "\n"
 #    return markdown
 
+def submodules(module_name):
+    """
+    Return the name of a module followed by the names of its submodules.
+    """
+    module = importlib.import_module(module_name)
+    names = [module_name]
+    path = getattr(module, "__path__", None)
+    if path:
+        for _, name, _ in pkgutil.walk_packages(path, module_name + "."):
+            names.append(name)
+    return names
+
+def document(module_name, filename=None, debug=False, incremental=False):
+    """
+    Return the markdown documentation of the module named `module_name`.
+
+    See `iter_document`.
+    """
+    return "".join(iter_document(module_name, filename, debug, incremental))
+
+def iter_document(module_name, filename=None, debug=False, incremental=False):
+    """
+    Produce the markdown documentation of a module as a sequence of chunks.
+
+    The module source is read in `filename`, that defaults to the module 
+    source file.
+    """
+    with profile.stage("import"):
+        module = importlib.import_module(module_name)
+    filename = filename or inspect.getsourcefile(module)
+    if filename is None:
+        raise RuntimeError("missing input filename")
+    source = open(filename).read()
+    return iter_docgen(module, source, debug, incremental, filename)
+
+def _document(args):
+    # Process pool entry point: also return the cache counters of the task.
+    # A worker process may document several modules, so the counters are
+    # reset first; otherwise they would be added up several times.
+    for cache in _caches():
+        cache.hits = cache.misses = 0
+    if profile.enabled: # and so is the profile of the task.
+        profile.clear()
+    markdown = document(*args)
+    counters = [(cache.hits, cache.misses) for cache in _caches()]
+    report = profile.report() if profile.enabled else None
+    return markdown, counters, report
+
+def _caches():
+    return [pandoc_cache, render_cache, parse_cache]
+
+#
+# Output Backends
+# ------------------------------------------------------------------------------
+#
+# The documentation is written by the backend registered for the extension
+# of the output file. The markdown is given to pandoc in a temporary file,
+# written chunk by chunk; the HTML backend needs no external converter.
+# The output files are replaced atomically, so that a document viewer never
+# reads a partially written file.
+#
+
+def build_dir(output):
+    """
+    Return the persistent build directory of the document `output`.
+
+    The directory is named after the output file name and the hash of its 
+    absolute path, in the `build` subdirectory of the cache directory.
+    It is `None` when the caches are disabled.
+    """
+    root = cache_dir()
+    if not root:
+        return None
+    name = os.path.basename(output) + "-" + Cache.key(os.path.abspath(output))[:8]
+    return os.path.join(root, "build", name)
+
+def _contents(filename):
+    try:
+        with open(filename, "rb") as file:
+            return file.read()
+    except IOError:
+        return None
+
+@contextlib.contextmanager
+def _replace(filename):
+    # Yield a temporary file that replaces `filename` when it is closed.
+    import tempfile
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=dirname, prefix=".docgen-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            yield file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp, 0666 & ~umask) # mkstemp creates private files
+        os.rename(temp, filename) # atomic
+    except:
+        os.remove(temp)
+        raise
+
+def build_pdf(latex, output, max_runs=3):
+    """
+    Build the PDF document `output` from the `latex` source.
+
+    The build happens in the directory `build_dir(output)`, that is reused
+    across builds: the LaTeX stage is skipped when `latex` is identical to 
+    the source of the last build and xelatex is run again only as long as 
+    the `.aux` and `.toc` files change (at most `max_runs` times).
+
+    Returns the list of `(stage, seconds)` timings.
+    """
+    import shutil
+    import sh
+    import tempfile
+    timings = []
+    build = build_dir(output)
+    temporary = build is None
+    if temporary:
+        build = tempfile.mkdtemp()
+    elif not os.path.isdir(build):
+        os.makedirs(build)
+    basename = ".".join(os.path.basename(output).split(".")[:-1])
+    tex, pdf = [os.path.join(build, basename + ext) for ext in (".tex", ".pdf")]
+    watched = [os.path.join(build, basename + ext) for ext in (".aux", ".toc")]
+    try:
+        start = time.time()
+        if _contents(tex) == latex and os.path.exists(pdf):
+            timings.append(("xelatex (unchanged source)", time.time() - start))
+        else:
+            with open(tex, "wb") as file:
+                file.write(latex)
+            try:
+                runs = 0
+                while runs < max_runs:
+                    before = [_contents(filename) for filename in watched]
+                    sh.xelatex(basename + ".tex", _cwd=build)
+                    runs += 1
+                    if [_contents(filename) for filename in watched] == before:
+                        break
+            except:
+                os.remove(tex) # no stale build
+                raise
+            stage = "xelatex ({0} run{1})".format(runs, "s" if runs > 1 else "")
+            timings.append((stage, time.time() - start))
+        start = time.time()
+        with open(pdf, "rb") as source, _replace(output) as file:
+            shutil.copyfileobj(source, file)
+        timings.append(("copy", time.time() - start))
+    finally:
+        if temporary:
+            shutil.rmtree(build, ignore_errors=True)
+    return timings
+
+_backends = {}
+
+def backend(*extensions):
+    """
+    Register an output backend for the given file extensions.
+
+    A backend is called with a sequence of markdown chunks and the output 
+    file name; it returns the list of `(stage, seconds)` timings.
+    """
+    def register(backend):
+        for extension in extensions:
+            _backends[extension] = backend
+        return backend
+    return register
+
+def spool(chunks):
+    """
+    Write a sequence of chunks in a temporary file.
+
+    Returns the file name and the SHA-1 hash of the file content.
+    """
+    import tempfile
+    hash = hashlib.sha1()
+    fd, filename = tempfile.mkstemp(suffix=".md")
+    with os.fdopen(fd, "wb") as file:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode("utf-8")
+            hash.update(chunk)
+            file.write(chunk)
+    return filename, hash.hexdigest()
+
+def pandoc_file(filename, digest=None, **options):
+    """
+    Convert the file `filename` with pandoc and return the result.
+
+    The `options` are the pandoc command-line options. When the `digest` 
+    of the file content is given, the result is stored in `pandoc_cache`.
+    """
+    import subprocess
+    import tempfile
+    if digest is not None:
+        key = Cache.key(pandoc_key("", **options), digest)
+        output = pandoc_cache.get(key)
+        if output is not None:
+            return output
+    args = ["pandoc"]
+    for name, value in sorted(options.items()):
+        if value is True:
+            args.append("--" + name)
+        else:
+            args.append("--{0}={1}".format(name, value))
+    fd, result = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        start = time.time()
+        subprocess.check_call(args + ["--output=" + result, filename])
+        profile.pandoc_call(time.time() - start)
+        output = _contents(result)
+    finally:
+        os.remove(result)
+    if digest is not None:
+        pandoc_cache.set(key, output)
+    return output
+
+def _latex(chunks):
+    timings = []
+    start = time.time()
+    filename, digest = spool(chunks)
+    timings.append(("markdown", time.time() - start))
+    try:
+        start = time.time()
+        latex = pandoc_file(filename, digest, read="markdown", toc=True, 
+                            standalone=True, write="latex")
+        timings.append(("pandoc", time.time() - start))
+    finally:
+        os.remove(filename)
+    return latex, timings
+
+@backend("md")
+def write_markdown(chunks, output):
+    "Write the markdown documentation"
+    start = time.time()
+    with _replace(output) as file:
+        for chunk in chunks:
+            file.write(chunk)
+    return [("markdown", time.time() - start)]
+
+@backend("tex")
+def write_latex(chunks, output):
+    "Convert the documentation to LaTeX with pandoc"
+    latex, timings = _latex(chunks)
+    with _replace(output) as file:
+        file.write(latex)
+    return timings
+
+@backend("pdf")
+def write_pdf(chunks, output):
+    "Convert the documentation to PDF with pandoc and xelatex"
+    latex, timings = _latex(chunks)
+    return timings + build_pdf(latex, output)
+
+@backend("html", "htm")
+def write_html(chunks, output):
+    "Convert the documentation to HTML (see `iter_html`)"
+    start = time.time()
+    title = ".".join(os.path.basename(output).split(".")[:-1])
+    with _replace(output) as file:
+        for html in iter_html(chunks, title):
+            file.write(html.encode("utf-8"))
+    return [("html", time.time() - start)]
+
+#
+# The HTML writer handles the subset of markdown that docgen produces: 
+# headers, paragraphs, lists, code blocks, raw HTML and the most common 
+# inline markup. The labelled reference links (`[text][label]`) are replaced
+# by placeholders when the blocks are rendered; a block that refers to an 
+# undefined label is held back -- with the blocks that follow -- until the 
+# label is defined or the document ends. The brackets of the object headers 
+# (``[`function`]``) are not links, hence the shortcut links (`[label]`) 
+# are links only when their label is already defined.
+#
+
+_html_template = u"""\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{0}</title>
+<style>
+body {{ max-width: 50em; margin: 2em auto; padding: 0 1em; 
+       font-family: sans-serif; line-height: 1.4; }}
+pre {{ background: #f6f6f6; padding: 0.5em; overflow: auto; }}
+</style>
+</head>
+<body>
+"""
+
+_html_header = re.compile(r"(#{1,6})\s+(.*?)\s*#*\s*$").match
+_html_underline = re.compile(r"(=+|-+)\s*$").match
+_html_rule = re.compile(r" {0,3}((\*\s*){3,}|(-\s*){3,})$").match
+_html_item = re.compile(r" {0,3}([-*+]|\d+[.)])\s+(.*)$").match
+_html_fence = re.compile(r"\s*(`{3,}|~{3,})").match
+_html_reference = re.compile(
+  r""" {0,3}\[([^\]^][^\]]*)\]:\s*<?([^\s>]+)>?(\s+(".*"|'.*'|\(.*\)))?\s*$""").match
+_html_block = re.compile(r" {0,3}<(!--|/?[A-Za-z][\w-]*(\s|/?>|$))").match
+_html_raw = re.compile(
+  r"<!--.*?-->|</?[A-Za-z][\w-]*(\s+[^<>]*)?/?>|&(#?\w+);", re.DOTALL)
+_html_autolink = re.compile(r"<((https?|ftp|mailto):[^\s<>]+)>")
+_html_span = re.compile(
+  r"(`+)(.+?)\1|(?<!\\)\[((?:`[^`]*`|[^\]`])+)\](?:\(([^)\s]+)\)|\[([^\]]*)\])?", 
+  re.DOTALL)
+_html_backslash = re.compile(r"\\([\\`*_{}\[\]()#+\-.!])")
+_html_link = re.compile(r"\x00([^\x00\x01]*)\x01([^\x00\x01]*)\x01([^\x00]*)\x00")
+
+def _html_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _html_label(label):
+    return " ".join(label.lower().split())
+
+def _html_entity(match):
+    return "&#{0};".format(ord(match.group(1)))
+
+def _html_text(text):
+    # The escaped characters become entities, that are copied as they are.
+    text = _html_backslash.sub(_html_entity, text)
+    html, start = [], 0
+    for match in _html_raw.finditer(text):
+        html.append(_html_escape(text[start:match.start()]))
+        html.append(match.group(0)) # raw HTML and entities
+        start = match.end()
+    html.append(_html_escape(text[start:]))
+    text = "".join(html)
+    text = re.sub(r"\*\*(?=\S)(.+?)(?<=\S)\*\*", r"<strong>\1</strong>", text)
+    text = re.sub(r"(?<![\w*])\*(?=\S)(.+?)(?<=\S)\*(?![\w*])", r"<em>\1</em>", 
+                  text)
+    return text
+
+def _html_inline(text, references):
+    # The reference links are the links with a label and the shortcut links
+    # whose label is already defined; the other brackets are text.
+    text = _html_autolink.sub(r"[\1](\1)", text)
+    html, start = [], 0
+    for match in _html_span.finditer(text):
+        html.append(_html_text(text[start:match.start()]))
+        code, content, url, label = match.group(2, 3, 4, 5)
+        if code is not None:
+            html.append("<code>" + _html_escape(code.strip()) + "</code>")
+        elif url is not None:
+            url = _html_escape(url)
+            content = _html_inline(content, references)
+            html.append(u'<a href="{0}">{1}</a>'.format(url, content))
+        elif label is None and _html_label(content) not in references:
+            html.append("[" + _html_inline(content, references) + "]")
+        else: # reference link, see `_html_resolve`
+            key = _html_label(label or content)
+            content = _html_inline(content, references)
+            source = "[" + content + "]"
+            if label is not None:
+                source += "[" + _html_escape(label) + "]"
+            html.append(u"\x00{0}\x01{1}\x01{2}\x00".format(key, content, source))
+        start = match.end()
+    html.append(_html_text(text[start:]))
+    return "".join(html)
+
+def _html_resolve(html, references):
+    def anchor(match):
+        key, text, source = match.groups()
+        if key in references:
+            return u'<a href="{0}">{1}</a>'.format(references[key], text)
+        else:
+            return source
+    return _html_link.sub(anchor, html)
+
+def _html_lines(chunks):
+    # The markdown chunks are decoded here and the HTML is encoded by the 
+    # caller: the HTML writer handles unicode text only.
+    buffer = u""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.decode("utf-8")
+        lines = (buffer + chunk).split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+def iter_html(chunks, title=""):
+    """
+    Convert a sequence of markdown chunks into a sequence of HTML chunks.
+
+    This lightweight writer handles headers, paragraphs, bullet and ordered
+    lists, indented and fenced code blocks, horizontal rules, raw HTML, 
+    code spans, inline and reference links, strong emphasis and emphasis. 
+    The HTML is produced as the markdown chunks arrive, except for the 
+    blocks that use a labelled reference link whose definition comes later;
+    the shortcut reference links (`[label]`) must be defined before they are
+    used. The markdown chunks are UTF-8 or unicode strings, the HTML chunks 
+    are unicode strings.
+    """
+    if isinstance(title, str):
+        title = title.decode("utf-8")
+    yield _html_template.format(_html_escape(title))
+    references, pending = {}, []
+    for html in _html_blocks(_html_lines(chunks), references):
+        if not html:
+            continue
+        pending.append(html)
+        while pending:
+            keys = _html_link.findall(pending[0])
+            if any(key not in references for key, _, _ in keys):
+                break
+            yield _html_resolve(pending.pop(0), references)
+    for html in pending:
+        yield _html_resolve(html, references)
+    yield "</body>\n</html>\n"
+
+def _html_blocks(lines, references):
+    # Yield the HTML blocks of the markdown `lines`; the reference link 
+    # definitions are stored in `references` instead.
+    paragraph, items, code, raw = [], [], [], []
+    state = {"fence": None, "ordered": False, "blank": False}
+
+    def flush():
+        html = []
+        if paragraph:
+            text = _html_inline("\n".join(paragraph), references)
+            html.append("<p>" + text + "</p>\n")
+        if items:
+            tag = "ol" if state["ordered"] else "ul"
+            html.append("<{0}>\n".format(tag))
+            for item in items:
+                text = _html_inline("\n".join(item), references)
+                html.append("<li>" + text + "</li>\n")
+            html.append("</{0}>\n".format(tag))
+        if code:
+            while code and not code[-1].strip():
+                code.pop()
+            text = _html_escape("\n".join(code) + "\n")
+            html.append("<pre><code>" + text + "</code></pre>\n")
+        if raw:
+            html.append("\n".join(raw) + "\n")
+        del paragraph[:], items[:], code[:], raw[:]
+        state["fence"], state["blank"] = None, False
+        return "".join(html)
+
+    for line in lines:
+        indented = line.startswith("    ") or line.startswith("\t")
+        if state["fence"] is not None:
+            if line.strip().startswith(state["fence"]):
+                yield flush()
+            else:
+                code.append(line)
+            continue
+        if code and (indented or not line.strip()):
+            code.append(line[4:] if line.startswith("    ") else line[1:])
+            continue
+        elif code:
+            yield flush()
+        if raw:
+            if line.strip():
+                raw.append(line)
+            else:
+                yield flush()
+            continue
+        reference = _html_reference(line)
+        if reference:
+            label, url = reference.group(1), reference.group(2)
+            references.setdefault(_html_label(label), _html_escape(url))
+            continue
+        if not line.strip():
+            if items:
+                state["blank"] = True
+            else:
+                yield flush()
+            continue
+        item, fence, header = [match(line) for match in 
+                               (_html_item, _html_fence, _html_header)]
+        if items and not (item or fence or header) and \
+           (indented or not state["blank"]):
+            items[-1].append(line.strip())
+            state["blank"] = False
+            continue
+        if items and not item:
+            yield flush()
+        if fence:
+            yield flush()
+            state["fence"] = fence.group(1)[0] * 3
+        elif header:
+            yield flush()
+            level, text = len(header.group(1)), header.group(2)
+            text = _html_inline(text, references)
+            yield u"<h{0}>{1}</h{0}>\n".format(level, text)
+        elif len(paragraph) == 1 and _html_underline(line):
+            level, text = 1 if line[0] == "=" else 2, paragraph.pop()
+            yield flush()
+            text = _html_inline(text, references)
+            yield u"<h{0}>{1}</h{0}>\n".format(level, text)
+        elif not paragraph and _html_rule(line):
+            yield flush()
+            yield "<hr />\n"
+        elif not paragraph and _html_block(line):
+            yield flush()
+            raw.append(line)
+        elif item:
+            if paragraph or code:
+                yield flush()
+            if not items:
+                state["ordered"] = item.group(1)[0].isdigit()
+            items.append([item.group(2)])
+            state["blank"] = False
+        elif indented and not paragraph:
+            yield flush()
+            code.append(line[4:] if line.startswith("    ") else line[1:])
+        else:
+            paragraph.append(line)
+    yield flush()
+
+def render(markdown, output):
+    """
+    Write the `markdown` documentation to the file `output`.
+
+    The documentation is a string or a sequence of chunks. The backend is 
+    selected by the extension of `output` (see `backend`); the default is 
+    markdown.
+
+    Returns the list of `(stage, seconds)` timings.
+    """
+    if isinstance(markdown, basestring):
+        markdown = [markdown]
+    basename = os.path.basename(output)
+    if len(basename.split(".")) >= 2:
+        ext = basename.split(".")[-1]
+    else:
+        ext = None
+    with profile.stage("render") as entry:
+        timings = _backends.get(ext, write_markdown)(markdown, output)
+        if entry is not None:
+            # The backends consume the chunks in their first step.
+            steps = [[stage, seconds] for stage, seconds in timings]
+            steps[0][1] -= entry[1]
+            for stage, seconds in steps:
+                profile.add("render/" + stage, seconds)
+                entry[1] += seconds
+    return timings
+
 def help():
     """
 Return the following message:
 
-    docgen [options] module
+    docgen [options] module [module ...]
 
     options: -h, --help .................................. display help and exit
              -i FILE, --input=FILE ....................... Python module source file
              -o OUTPUT, --output=OUTPUT .................. documentation output
+             -w N, --workers=N ........................... number of pandoc workers
+             -s, --stats ................................. print cache statistics and build timings
+             --incremental ............................... format only the changed objects
+             -r, --recursive ............................. document the package submodules
+             -j N, --jobs=N .............................. number of modules documented in parallel
+             --fresh ..................................... analyse the sources without the parse cache
+             --clear ..................................... clear the parse cache first
+             --watch ..................................... regenerate OUTPUT when the sources change
+             --profile=REPORT ............................ write a JSON profile in REPORT
+
+    With several modules, the documentations are combined in a single 
+    document in the order of the command-line, unless OUTPUT is a directory: 
+    then every documentation is written in OUTPUT/MODULE.md.
+
+    With --watch, docgen keeps running and regenerates OUTPUT whenever the 
+    source of a module changes (see `watch`).
+
+    With --profile, a summary of the profile is also printed on the standard
+    error (see `Profile`).
 """
     return "\n".join([line[4:] for line in inspect.getdoc(help).split("\n")[2:]])
 
+def _is_dir(output):
+    return os.path.isdir(output) or output.endswith(os.sep)
+
+def build(module_names, output=None, filename=None, debug=False, incremental=False, jobs=1):
+    """
+    Generate the documentation of the modules in the file `output`.
+
+    The documentation is printed when `output` is `None`. The modules are 
+    documented by `jobs` processes when `jobs >= 2`.
+
+    Returns the list of `(stage, seconds)` timings of the rendering.
+    """
+    tasks = [(module_name, filename, debug, incremental) 
+             for module_name in module_names]
+    if jobs >= 2 and len(tasks) >= 2:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(_document, tasks) # ordered
+        finally:
+            pool.close()
+            pool.join()
+        for _, counters, report in results:
+            for cache, (hits, misses) in zip(_caches(), counters):
+                cache.hits += hits
+                cache.misses += misses
+            if report is not None:
+                profile.merge(report)
+        documents = [[markdown] for markdown, _, _ in results]
+    else: # streamed
+        documents = (iter_document(*task) for task in tasks)
+
+    timings = []
+    if output and _is_dir(output):
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        for module_name, chunks in zip(module_names, documents):
+            path = os.path.join(output, module_name + ".md")
+            timings.extend(render(chunks, path))
+    else:
+        def combine(documents):
+            for i, chunks in enumerate(documents):
+                if i:
+                    yield "\n\n"
+                for chunk in chunks:
+                    yield chunk
+        if not output:
+            with profile.stage("render"):
+                for chunk in combine(documents):
+                    sys.stdout.write(chunk)
+                sys.stdout.write("\n")
+        else:
+            timings = render(combine(documents), output)
+    return timings
+
+def _stamp(filename):
+    try:
+        stat = os.stat(filename)
+        return stat.st_mtime, stat.st_size
+    except OSError:
+        return None
+
+def watch(module_names, output, filename=None, debug=False, stats=False, interval=0.5):
+    """
+    Regenerate the documentation `output` whenever a module source changes.
+
+    The source files are polled every `interval` seconds; the modules that
+    have changed are reloaded and the documentation is built again in 
+    incremental mode, hence only the changed objects are formatted. When 
+    `output` is a directory, only the documentation of the changed modules 
+    is written. The errors are reported and the watch goes on until it is
+    interrupted.
+    """
+    import traceback
+    sources = []
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        sources.append(filename or inspect.getsourcefile(module))
+    stamps = [None] * len(module_names)
+    loaded = True
+    try:
+        while True:
+            changed = [i for i, source in enumerate(sources) 
+                         if _stamp(source) != stamps[i]]
+            if changed:
+                for i in changed:
+                    stamps[i] = _stamp(sources[i])
+                names = [module_names[i] for i in changed]
+                start = time.time()
+                try:
+                    if not loaded:
+                        for name in names:
+                            reload(sys.modules[name])
+                    _failed_imports.clear() # the imports may succeed now.
+                    if not _is_dir(output):
+                        names = module_names
+                    timings = build(names, output, filename, debug, True)
+                except Exception:
+                    traceback.print_exc()
+                else:
+                    seconds = time.time() - start
+                    print >> sys.stderr, "{0}: {1} updated in {2:.3f}s".format(
+                      time.strftime("%H:%M:%S"), output, seconds)
+                    if stats:
+                        for stage, seconds in timings:
+                            print >> sys.stderr, "  {0}: {1:.3f}s".format(
+                              stage, seconds)
+                loaded = False
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _pandoc_pool.close()
+
 def main(args=None):
+    import script
     if args is None:
         args = sys.argv[1:]
-    options, args = script.parse("help input= output= debug", args)
+    spec = "help input= output= workers= stats incremental recursive jobs= " \
+           "fresh clear watch profile= debug"
+    options, args = script.parse(spec, args)
     if options.help:
         print help()
         sys.exit(0)
-    elif not args or len(args) > 1:
+    elif not args:
         print help()
         sys.exit(1)
     else:
-        module_name = args[0]
+        module_names = args
 
-    module = importlib.import_module(module_name)
-    filename = script.first(options.input) or inspect.getsourcefile(module)
-    if filename is None:
-        raise RuntimeError("missing input filename")
-    source = open(filename).read()
+    if options.recursive:
+        module_names = [name for module_name in module_names 
+                             for name in submodules(module_name)]
+
+    if options.input and len(module_names) > 1: # a single source file
+        print help()
+        sys.exit(1)
+
+    filename = script.first(options.input)
 
     debug = bool(options.debug)
 
-    markdown = docgen(module, source, debug)
-    if not options.output:
-        print markdown
+    workers = script.first(options.workers)
+    if workers is not None:
+        _pandoc_pool.resize(workers)
+
+    incremental = bool(options.incremental)
+
+    if options.clear:
+        parse_cache.clear()
+    if options.fresh:
+        parse_cache.disable()
+
+    jobs = int(script.first(options.jobs) or 1)
+
+    output = script.first(options.output)
+
+    report = script.first(options.profile)
+    if report:
+        profile.enable()
+
+    if options.watch:
+        if not output:
+            print help()
+            sys.exit(1)
+        watch(module_names, output, filename, debug, bool(options.stats))
+        timings = []
     else:
-        output = script.first(options.output)
-        basename = os.path.basename(output)
-        if len(basename.split(".")) >= 2:
-            ext = basename.split(".")[-1]
-        else:
-            ext = None
-        if ext == "tex":
-            sh.pandoc(read="markdown", toc=True, standalone=True, write="latex", o=output, _in=markdown)
-        elif ext == "pdf":
-            try: # keep that somewhere, but use pandoc to generate the pdf ?
-                latex = ".".join(basename.split(".")[:-1]) + ".tex"
-                build = tempfile.mkdtemp()
-                cwd = os.getcwd()
-                os.chdir(build)
-                sh.pandoc(read="markdown", toc=True, standalone=True, write="latex", o=latex, _in=markdown)
-                sh.xelatex(latex)
-                sh.xelatex(latex)
-                os.chdir(cwd)
-                sh.cp(os.path.join(build, latex[:-4] + ".pdf"), output)
-            finally:
-                try:
-                    shutil.rmtree(build) # delete directory
-                except OSError, e:
-                    if e.errno != 2: # code 2 - no such file or directory
-                        raise
-        else:
-            file = open(output, "w")
-            file.write(markdown)
-            file.close()
+        timings = build(module_names, output, filename, debug, incremental, 
+                        jobs)
+
+    if report:
+        data = profile.report()
+        with open(report, "w") as file:
+            json.dump(data, file, indent=2, sort_keys=True)
+        print >> sys.stderr, profile.summary(data)
+
+    if options.stats:
+        print >> sys.stderr, "pandoc cache:", pandoc_cache.stats()
+        print >> sys.stderr, "parse cache:", parse_cache.stats()
+        if incremental:
+            print >> sys.stderr, "render cache:", render_cache.stats()
+        for stage, seconds in timings:
+            print >> sys.stderr, "{0}: {1:.3f}s".format(stage, seconds)
 
 def test():
     # erf, does not work ???